@@ -0,0 +1,84 @@
+"""Asyncio access to the vault data layer
+
+Every call runs on a dedicated thread pool instead of the event loop. Each
+worker thread gets its own SQLite connection from database.py, and Fernet
+work happens on those threads too, so a slow disk or a big decrypt never
+stalls other requests.
+
+At most max_pending calls can be queued or running at once. Past that,
+callers wait for a free slot, which pushes back on whatever is producing
+requests.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from auth import find_user, check_login
+from database import log_security_event, log_failed_attempt, is_account_locked, flush_audit_log
+from emergency import fetch_emergency_contacts
+from vault import fetch_user_entries, load_ciphertexts, decrypt_entries
+
+def _fetch_encrypted_entries(user_id):
+    # Listings fetch ciphertext on first access, which would mean a blocking
+    # query on the event loop; load it here on the worker thread instead
+    entries = fetch_user_entries(user_id)
+    load_ciphertexts(entries)
+    return entries
+
+class AsyncRepository:
+    """Awaitable versions of the managers' data access calls"""
+
+    def __init__(self, max_workers=4, max_pending=64):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vault-db")
+        self._max_pending = max_pending
+        self._slots = None
+
+    async def _run(self, func, *args, **kwargs):
+        if self._slots is None:
+            # Created lazily so it belongs to the loop that first uses it
+            self._slots = asyncio.Semaphore(self._max_pending)
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def load_user_data(self, user_id):
+        """A user's entries, still encrypted
+
+        Decrypt them with decrypt_entries rather than get_decrypted_content,
+        which would load the user's keys and decrypt on the event loop.
+        """
+        return await self._run(_fetch_encrypted_entries, user_id)
+
+    async def decrypt_entries(self, entries):
+        """Plaintext for each entry, in order"""
+        return await self._run(decrypt_entries, entries)
+
+    async def find_user(self, username):
+        return await self._run(find_user, username)
+
+    async def check_login(self, username, password):
+        """(user, status) as returned by auth.check_login"""
+        return await self._run(check_login, username, password)
+
+    async def get_emergency_contacts(self, user_id):
+        return await self._run(fetch_emergency_contacts, user_id)
+
+    async def log_security_event(self, user_id, action, ip_address="localhost", details=""):
+        await self._run(log_security_event, user_id, action, ip_address, details)
+
+    async def log_failed_attempt(self, user_id, attempt_type, ip_address="localhost"):
+        await self._run(log_failed_attempt, user_id, attempt_type, ip_address)
+
+    async def is_account_locked(self, user_id, attempt_type="pin"):
+        return await self._run(is_account_locked, user_id, attempt_type)
+
+    async def close(self):
+        """Drain queued audit rows and stop the worker threads"""
+        await self._run(flush_audit_log)
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
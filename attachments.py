@@ -0,0 +1,316 @@
+"""Encrypted file attachments for vault entries
+
+A file is read CHUNK_SIZE bytes at a time. Each chunk is encrypted on its
+own and written to a content-addressed blob store next to the database
+(vault.db -> vault_blobs/). The attachments and attachment_chunks tables
+record which blobs make up which file, in order. Only one chunk is ever
+in memory, so files of any size can be stored and read back, and a byte
+range can be read by decrypting just the chunks that cover it.
+
+Chunks are encrypted with the owner's data key, and a blob's address is an
+HMAC of the chunk's plaintext under a key derived from the owner's index
+key (see key_store.py). A user's identical chunks are stored once, the
+address gives nothing away without the key, and every read checks the
+decrypted chunk against its address.
+
+Blobs are written before the rows that refer to them, and a shared one may
+be found unreferenced and deleted by another process in between. So blobs
+are only deleted under the database write lock, and a writer checks, under
+that same lock, that its blobs still exist before committing its rows,
+rewriting any that went missing. Blobs written before per-user keys
+carry an address under the master key until key_rotation.py moves them.
+
+Usage:
+    python attachments.py add USERNAME ENTRY_ID FILE
+    python attachments.py list USERNAME ENTRY_ID
+    python attachments.py get USERNAME ATTACHMENT_ID DEST
+    python attachments.py prune
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+from database import transaction, fetch_one, fetch_all, get_connection, get_database_path, log_security_event
+from encryption import derive_key
+from key_store import get_keyring, with_keyring
+
+CHUNK_SIZE = 1024 * 1024
+FERNET_VERSION = b"\x80"
+
+_legacy_address_key = None
+
+def get_blob_dir():
+    """vault.db -> vault_blobs/, in the same directory"""
+    root, _ = os.path.splitext(get_database_path())
+    return root + "_blobs"
+
+def _blob_path(blob_id):
+    return os.path.join(get_blob_dir(), blob_id[:2], blob_id[2:4], blob_id)
+
+def _address(keyring, chunk):
+    return hmac.new(keyring.subkey(b"attachment-chunk"), chunk, hashlib.sha256).hexdigest()
+
+def _legacy_address(chunk):
+    global _legacy_address_key
+    if _legacy_address_key is None:
+        _legacy_address_key = derive_key(b"lifevault-attachment-chunk-v1")
+    return hmac.new(_legacy_address_key, chunk, hashlib.sha256).hexdigest()
+
+def _write_blob(keyring, chunk, replace=False):
+    """Store one plaintext chunk, encrypted, and return its blob id
+
+    An existing blob with the same address is kept unless replace is set,
+    which re-encrypts it under the current data key.
+    """
+    blob_id = _address(keyring, chunk)
+    path = _blob_path(blob_id)
+    if os.path.exists(path) and not replace:
+        return blob_id
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Attached files are mostly PDFs and images, already compressed
+    data = keyring.encrypt(chunk, compress=False)
+    with open(path + ".partial", "wb") as f:
+        f.write(data)
+    os.replace(path + ".partial", path)
+    return blob_id
+
+def _read_blob(user_id, blob_id):
+    with open(_blob_path(blob_id), "rb") as f:
+        token = f.read()
+    if token[:1] == FERNET_VERSION:
+        # Written before the binary format: a Fernet token with its base64 stripped
+        token = base64.urlsafe_b64encode(token)
+    chunk = with_keyring(user_id, lambda keyring: keyring.decrypt(token))
+    keyring = get_keyring(user_id)
+    if not hmac.compare_digest(_address(keyring, chunk), blob_id):
+        if not (keyring.has_legacy_data and hmac.compare_digest(_legacy_address(chunk), blob_id)):
+            raise ValueError("blob {} does not match its address".format(blob_id))
+    return chunk
+
+def _reference_blobs(blob_ids, rewrite, write_rows):
+    """Run write_rows(conn) in a write transaction once every one of blob_ids exists
+
+    remove_unreferenced deletes under the same lock, so the blobs seen here
+    are still there when the rows commit. Missing ones are rewritten with
+    rewrite(blob_id) and checked again.
+    """
+    conn = get_connection()
+    while True:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            missing = [blob_id for blob_id in dict.fromkeys(blob_ids) if not os.path.exists(_blob_path(blob_id))]
+            if not missing:
+                return write_rows(conn)
+        for blob_id in missing:
+            rewrite(blob_id)
+
+def add_attachment(user_id, entry_id, path, filename=None):
+    """Encrypt a file into the blob store and attach it to an entry; returns the attachment id"""
+    owner = fetch_one("SELECT user_id FROM vault WHERE id = ?", (entry_id,))
+    if not owner or owner[0] != user_id:
+        raise ValueError("entry {} does not belong to this user".format(entry_id))
+
+    keyring = get_keyring(user_id)
+    blob_ids = []
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            blob_ids.append(_write_blob(keyring, chunk))
+            size += len(chunk)
+
+    def rewrite(blob_id):
+        with open(path, "rb") as f:
+            f.seek(blob_ids.index(blob_id) * CHUNK_SIZE)
+            if _write_blob(keyring, f.read(CHUNK_SIZE)) != blob_id:
+                raise ValueError("{} changed while it was being attached".format(path))
+
+    def write_rows(conn):
+        attachment_id = conn.execute(
+            "INSERT INTO attachments (user_id, entry_id, filename, size, chunk_size, chunk_count) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, entry_id, filename, size, CHUNK_SIZE, len(blob_ids))
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO attachment_chunks (attachment_id, chunk_index, blob_id) VALUES (?, ?, ?)",
+            [(attachment_id, index, blob_id) for index, blob_id in enumerate(blob_ids)]
+        )
+        return attachment_id
+
+    filename = filename or os.path.basename(path)
+    attachment_id = _reference_blobs(blob_ids, rewrite, write_rows)
+    log_security_event(user_id, "attachment_added", details=f"Entry ID: {entry_id}, File: {filename}")
+    return attachment_id
+
+def list_attachments(user_id, entry_id):
+    """(id, filename, size, created_at) for each of an entry's attachments"""
+    return fetch_all(
+        "SELECT id, filename, size, created_at FROM attachments WHERE user_id = ? AND entry_id = ? ORDER BY id",
+        (user_id, entry_id)
+    )
+
+def _get_attachment(user_id, attachment_id):
+    row = fetch_one(
+        "SELECT size, chunk_size, chunk_count FROM attachments WHERE id = ? AND user_id = ?",
+        (attachment_id, user_id)
+    )
+    if not row:
+        raise KeyError("no attachment {} for this user".format(attachment_id))
+    return row
+
+def read_chunk(user_id, attachment_id, index):
+    """Plaintext of one chunk"""
+    _get_attachment(user_id, attachment_id)
+    row = fetch_one(
+        "SELECT blob_id FROM attachment_chunks WHERE attachment_id = ? AND chunk_index = ?",
+        (attachment_id, index)
+    )
+    if not row:
+        raise IndexError("attachment {} has no chunk {}".format(attachment_id, index))
+    return _read_blob(user_id, row[0])
+
+def iter_range(user_id, attachment_id, offset=0, length=None):
+    """Yield the bytes of [offset, offset + length), decrypting only the chunks that cover it"""
+    size, chunk_size, _ = _get_attachment(user_id, attachment_id)
+    end = size if length is None else min(size, offset + length)
+    if offset >= end:
+        return
+    rows = fetch_all(
+        "SELECT chunk_index, blob_id FROM attachment_chunks WHERE attachment_id = ? AND chunk_index BETWEEN ? AND ? ORDER BY chunk_index",
+        (attachment_id, offset // chunk_size, (end - 1) // chunk_size)
+    )
+    for index, blob_id in rows:
+        start = index * chunk_size
+        chunk = _read_blob(user_id, blob_id)
+        yield chunk[max(offset - start, 0):end - start]
+
+def read_range(user_id, attachment_id, offset, length):
+    return b"".join(iter_range(user_id, attachment_id, offset, length))
+
+def export_attachment(user_id, attachment_id, dest_path):
+    """Decrypt a whole attachment to dest_path, one chunk at a time"""
+    with open(dest_path + ".partial", "wb") as f:
+        for data in iter_range(user_id, attachment_id):
+            f.write(data)
+    os.replace(dest_path + ".partial", dest_path)
+    return dest_path
+
+def delete_attachment(user_id, attachment_id):
+    blob_ids = [row[0] for row in fetch_all(
+        "SELECT blob_id FROM attachment_chunks WHERE attachment_id = ?", (attachment_id,)
+    )]
+    with transaction() as conn:
+        deleted = conn.execute(
+            "DELETE FROM attachments WHERE id = ? AND user_id = ?", (attachment_id, user_id)
+        ).rowcount
+    if deleted:
+        remove_unreferenced(blob_ids)
+    return bool(deleted)
+
+def reencrypt_attachment(user_id, attachment_id):
+    """Rewrite an attachment's chunks under the user's current data key and address key
+
+    Used by key rotation. Blobs whose address doesn't change are replaced in
+    place; the rest are written under their new address and the old blobs
+    removed once nothing uses them. Returns the number of chunks rewritten.
+    """
+    keyring = get_keyring(user_id)
+    rows = fetch_all(
+        "SELECT chunk_index, blob_id FROM attachment_chunks WHERE attachment_id = ? ORDER BY chunk_index",
+        (attachment_id,)
+    )
+    moved = {}
+    for _, blob_id in rows:
+        if blob_id not in moved:
+            moved[blob_id] = _write_blob(keyring, _read_blob(user_id, blob_id), replace=True)
+    changed = [(new_id, attachment_id, old_id) for old_id, new_id in moved.items() if new_id != old_id]
+    if changed:
+        old_ids = {new_id: old_id for new_id, _, old_id in changed}
+        # The old blob is still referenced, so it can always be read again
+        _reference_blobs(
+            old_ids,
+            lambda new_id: _write_blob(keyring, _read_blob(user_id, old_ids[new_id]), replace=True),
+            lambda conn: conn.executemany(
+                "UPDATE attachment_chunks SET blob_id = ? WHERE attachment_id = ? AND blob_id = ?", changed
+            )
+        )
+        remove_unreferenced([old_id for _, _, old_id in changed])
+    return len(rows)
+
+def entry_blob_ids(entry_id):
+    """Blobs used by an entry's attachments, to pass to remove_unreferenced once it's deleted"""
+    return [row[0] for row in fetch_all(
+        """SELECT DISTINCT c.blob_id FROM attachments a
+           JOIN attachment_chunks c ON c.attachment_id = a.id WHERE a.entry_id = ?""",
+        (entry_id,)
+    )]
+
+def remove_unreferenced(blob_ids):
+    """Delete those of blob_ids that no attachment uses any more"""
+    removed = 0
+    if not blob_ids:
+        return removed
+    conn = get_connection()
+    with conn:
+        # Held across check and delete; see _reference_blobs
+        conn.execute("BEGIN IMMEDIATE")
+        for blob_id in set(blob_ids):
+            if not conn.execute("SELECT 1 FROM attachment_chunks WHERE blob_id = ? LIMIT 1", (blob_id,)).fetchone():
+                try:
+                    os.remove(_blob_path(blob_id))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+def prune_blobs():
+    """Remove blobs no attachment refers to, such as those of deleted entries"""
+    blob_dir = get_blob_dir()
+    if not os.path.isdir(blob_dir):
+        return 0
+    found = []
+    for dirpath, _, filenames in os.walk(blob_dir):
+        found.extend(name for name in filenames if not name.endswith(".partial"))
+    return remove_unreferenced(found)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage encrypted attachments of vault entries")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    add = subcommands.add_parser("add", help="attach a file to an entry")
+    add.add_argument("username")
+    add.add_argument("entry_id", type=int)
+    add.add_argument("path")
+    lst = subcommands.add_parser("list", help="list an entry's attachments")
+    lst.add_argument("username")
+    lst.add_argument("entry_id", type=int)
+    get = subcommands.add_parser("get", help="decrypt an attachment to a file")
+    get.add_argument("username")
+    get.add_argument("attachment_id", type=int)
+    get.add_argument("dest")
+    subcommands.add_parser("prune", help="delete blobs no attachment uses")
+    args = parser.parse_args(argv)
+
+    if args.command == "prune":
+        print("Removed {} unused blobs".format(prune_blobs()))
+        return
+    user = fetch_one("SELECT id FROM users WHERE username = ?", (args.username,))
+    if not user:
+        parser.error("unknown user {!r}".format(args.username))
+    if args.command == "add":
+        print("Added attachment {}".format(add_attachment(user[0], args.entry_id, args.path)))
+    elif args.command == "list":
+        rows = list_attachments(user[0], args.entry_id)
+        print(json.dumps([dict(zip(("id", "filename", "size", "created_at"), row)) for row in rows], indent=2))
+    else:
+        print("Written to {}".format(export_attachment(user[0], args.attachment_id, args.dest)))
+
+if __name__ == "__main__":
+    from database import close_db
+    try:
+        main()
+    finally:
+        close_db()
@@ -1,19 +1,87 @@
 import hashlib
 import getpass
 import re
-from database import get_cursor, get_connection, log_security_event, log_failed_attempt, is_account_locked
+from database import execute, fetch_one, fetch_all, log_security_event, log_failed_attempt, is_account_locked
 from ascii_ui import print_error, print_success, print_warning, print_info, print_security_warning, refresh_screen
-from models import User
+from models import User, CATEGORIES, find_category_id
+from vault import decrypt_entries, fetch_entries_in_categories
+
+LOGIN_OK = "ok"
+LOGIN_INVALID = "invalid"
+LOGIN_LOCKED = "locked"
+
+def hash_password(password):
+    """Hash password using SHA-256"""
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def find_user(username):
+    """Look up a user by username"""
+    user_data = fetch_one(
+        "SELECT id, username, password_hash, email, emergency_pin, created_at FROM users WHERE username = ?",
+        (username,)
+    )
+    return User(*user_data) if user_data else None
+
+def check_login(username, password):
+    """Verify credentials without prompting; returns (user, status)"""
+    user = find_user(username)
+    if not user:
+        return None, LOGIN_INVALID
+
+    # Check password
+    if hash_password(password) != user.password_hash:
+        log_failed_attempt(user.id, "login")
+        if is_account_locked(user.id, "login"):
+            log_security_event(user.id, "account_locked", details="Too many failed login attempts")
+        return None, LOGIN_INVALID
+
+    # Check if account is locked
+    if is_account_locked(user.id, "login"):
+        return None, LOGIN_LOCKED
+
+    log_security_event(user.id, "login_success")
+    return user, LOGIN_OK
+
+def verify_emergency_pin(user, pin):
+    """Check an emergency PIN, logging failed attempts and lockouts"""
+    if hash_password(pin) == user.emergency_pin:
+        log_security_event(user.id, "emergency_access_granted")
+        return True
+
+    log_failed_attempt(user.id, "pin")
+    log_security_event(user.id, "emergency_access_failed", details="Invalid PIN")
+    if is_account_locked(user.id, "pin"):
+        log_security_event(user.id, "account_locked", details="Too many failed PIN attempts")
+    return False
+
+def collect_emergency_data(user_id):
+    """Emergency contacts and the decrypted entries they may see, by category key
+
+    The Emergency category is always included; other categories only if
+    some contact was granted them.
+    """
+    contacts = fetch_all(
+        "SELECT id, name, phone, email, allowed_categories, created_at FROM emergency_contacts WHERE user_id = ?",
+        (user_id,)
+    )
+    category_ids = {CATEGORIES["emergency"]["id"]}
+    for contact in contacts:
+        category_ids.update(find_category_id(category) for category in contact[4].split(","))
+    category_ids.discard(None)
+    
+    entries = fetch_entries_in_categories(user_id, category_ids)
+    categories = {}
+    for entry, content in zip(entries, decrypt_entries(entries)):
+        categories.setdefault(entry.category_key, []).append((entry.title, content))
+    return contacts, categories
 
 class AuthManager:
     def __init__(self):
-        self.cursor = get_cursor()
-        self.conn = get_connection()
         self.current_user = None
 
     def hash_password(self, password):
         """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        return hash_password(password)
 
     def validate_email(self, email):
         """Basic email validation"""
@@ -41,8 +109,7 @@ class AuthManager:
                 continue
                 
             # Check if username exists
-            self.cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            if self.cursor.fetchone():
+            if fetch_one("SELECT id FROM users WHERE username = ?", (username,)):
                 print_error("Username already exists!")
                 continue
             break
@@ -84,13 +151,10 @@ class AuthManager:
         pin_hash = self.hash_password(pin)
         
         try:
-            self.cursor.execute(
+            user_id = execute(
                 "INSERT INTO users (username, password_hash, email, emergency_pin) VALUES (?, ?, ?, ?)",
                 (username, password_hash, email, pin_hash)
-            )
-            self.conn.commit()
-            
-            user_id = self.cursor.lastrowid
+            ).lastrowid
             log_security_event(user_id, "user_registration", details=f"New user: {username}")
             
             print_success("Account created successfully!")
@@ -113,37 +177,20 @@ class AuthManager:
             print_error("Username and password are required!")
             return False
         
-        # Get user
-        self.cursor.execute(
-            "SELECT id, username, password_hash, email, emergency_pin, created_at FROM users WHERE username = ?",
-            (username,)
-        )
-        user_data = self.cursor.fetchone()
-        
-        if not user_data:
+        user, status = check_login(username, password)
+        if status == LOGIN_INVALID:
             print_error("Invalid username or password!")
             return False
-        
-        user_id, db_username, db_password_hash, email, emergency_pin, created_at = user_data
-        
-        # Check password
-        if self.hash_password(password) != db_password_hash:
-            log_failed_attempt(user_id, "login")
-            print_error("Invalid username or password!")
-            return False
-        
-        # Check if account is locked
-        if is_account_locked(user_id, "login"):
+        if status == LOGIN_LOCKED:
             print_security_warning()
             return False
         
         # Success
-        self.current_user = User(user_id, db_username, db_password_hash, email, emergency_pin, created_at)
-        log_security_event(user_id, "login_success")
+        self.current_user = user
         print_success(f"Welcome back, {username}!")
         return True
 
-    def emergency_access(self, vault_manager):
+    def emergency_access(self):
         """Emergency access with PIN verification"""
         refresh_screen()
         print("\n🆘 Emergency Access")
@@ -155,54 +202,39 @@ class AuthManager:
             return False
         
         # Get user
-        self.cursor.execute(
-            "SELECT id, username, emergency_pin FROM users WHERE username = ?",
-            (username,)
-        )
-        user_data = self.cursor.fetchone()
-        
-        if not user_data:
+        user = find_user(username)
+        if not user:
             print_error("User not found!")
             return False
         
-        user_id, db_username, db_emergency_pin = user_data
-        
         # Check if account is locked
-        if is_account_locked(user_id, "pin"):
+        if is_account_locked(user.id, "pin"):
             print_security_warning()
             return False
         
         # PIN verification
         pin = getpass.getpass("4-digit Emergency PIN: ")
-        if self.hash_password(pin) != db_emergency_pin:
-            log_failed_attempt(user_id, "pin")
-            log_security_event(user_id, "emergency_access_failed", details="Invalid PIN")
+        if not verify_emergency_pin(user, pin):
             print_error("Invalid PIN!")
             
             # Check if account should be locked
-            if is_account_locked(user_id, "pin"):
+            if is_account_locked(user.id, "pin"):
                 print_security_warning()
             return False
         
         # Success - grant emergency access
-        log_security_event(user_id, "emergency_access_granted")
         print_success("Emergency access granted!")
         
         # Show emergency data
-        self._show_emergency_data(user_id, vault_manager)
+        self._show_emergency_data(user.id)
         return True
 
-    def _show_emergency_data(self, user_id, vault_manager):
+    def _show_emergency_data(self, user_id):
         """Show emergency data for the user"""
         print("\n🆘 Emergency Data Access")
         print("═" * 40)
         
-        # Get emergency contacts
-        self.cursor.execute(
-            "SELECT id, name, phone, email, allowed_categories, created_at FROM emergency_contacts WHERE user_id = ?",
-            (user_id,)
-        )
-        contacts = self.cursor.fetchall()
+        contacts, categories = collect_emergency_data(user_id)
         
         # Show emergency contacts if any exist
         if contacts:
@@ -217,29 +249,16 @@ class AuthManager:
         
         # Show accessible data
         print("\n📋 Accessible Data:")
-        vault_manager.load_user_data(user_id)
-        entries = vault_manager.data_entries
-        
-        if not entries:
+        if not categories:
             print_info("No data found for this user.")
             return
         
-        # Always include Emergency category entries in emergency mode
-        emergency_entries = [entry for entry in entries if entry.category.lower() == "emergency"]
-        
-        # Group by category
-        categories = {}
-        for entry in entries:
-            if entry.category not in categories:
-                categories[entry.category] = []
-            categories[entry.category].append(entry)
-        
         # Always show Emergency category first
-        if "Emergency" in categories:
+        if "emergency" in categories:
             print(f"\n🏷️  EMERGENCY (Always Accessible in Emergency Mode)")
             print("═" * 50)
-            for entry in categories["Emergency"]:
-                print(f"  • {entry.title}: {entry.get_decrypted_content()}")
+            for title, content in categories["emergency"]:
+                print(f"  • {title}: {content}")
         else:
             print(f"\n🏷️  EMERGENCY (Always Accessible in Emergency Mode)")
             print("═" * 50)
@@ -247,11 +266,11 @@ class AuthManager:
         
         # Show other categories that contacts have access to
         for category, category_entries in categories.items():
-            if category.lower() != "emergency":  # Skip emergency as it's already shown
-                print(f"\n🏷️  {category.upper()}")
+            if category != "emergency":  # Skip emergency as it's already shown
+                print(f"\n🏷️  {CATEGORIES[category]['name'].upper()}")
                 print("-" * 30)
-                for entry in category_entries:
-                    print(f"  • {entry.title}: {entry.get_decrypted_content()}")
+                for title, content in category_entries:
+                    print(f"  • {title}: {content}")
         
         input("\nPress Enter to continue...")
 
@@ -284,11 +303,10 @@ class AuthManager:
         
         # Update password
         new_password_hash = self.hash_password(new_password)
-        self.cursor.execute(
+        execute(
             "UPDATE users SET password_hash = ? WHERE id = ?",
             (new_password_hash, self.current_user.id)
         )
-        self.conn.commit()
         
         # Update current user object
         self.current_user.password_hash = new_password_hash
@@ -0,0 +1,256 @@
+"""Online backups and streaming exports of vault.db
+
+Snapshots use SQLite's online backup API, copying a few pages per step so
+the app can keep writing while a backup runs. Exports write one JSONL file
+per table; encrypted_data stays encrypted under the per-user keys in
+user_keys, which are themselves wrapped by secret.key, so secret.key is
+still needed to read an export and should be backed up separately.
+Re-encryption by key_rotation.py doesn't change updated_at, so take a full
+export once a data key rotation has finished. Attachment contents live in
+vault_blobs/ (see attachments.py), not in the database; copy that directory
+alongside a snapshot or export.
+
+Security logs older than 30 days live in the archive database vault_logs.db
+(see log_archive.py). A snapshot copies it next to the main copy
+(vault-backup.db -> vault-backup_logs.db), and an export writes each archived
+month as its own security_logs_YYYY_MM.jsonl. Archived rows keep their
+security_logs ids, so a row moved between two exports shows up in both under
+the same id.
+
+With --encrypt, snapshots and export files are also encrypted as a whole
+under the master key, streamed a segment at a time (see encryption.py), so
+titles, usernames and logs are covered too. Restoring one needs the
+secret.key that was current when it was written.
+
+Usage:
+    python backup.py snapshot DEST.db [--pages N] [--encrypt]
+    python backup.py export DEST_DIR [--incremental] [--encrypt]
+    python backup.py decrypt SOURCE DEST
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import sqlite3
+
+from database import open_connection, flush_audit_log
+from encryption import master_cipher, encrypt_file, decrypt_file, open_encrypted
+from log_archive import ARCHIVE_SCHEMA, get_archive_path, archive_partitions
+
+PAGES_PER_STEP = 256
+STEP_SLEEP = 0.005  # seconds between steps, lets writers in
+FETCH_SIZE = 1000
+MANIFEST = "manifest.json"
+ENCRYPTED_SUFFIX = ".enc"
+
+# Table -> column used as the "changed since" mark besides rowid
+EXPORT_TABLES = {
+    "users": None,
+    "vault": "updated_at",
+    "emergency_contacts": None,
+    "security_logs": None,
+    "failed_attempts": None,
+    "security_log_summary": None,
+    "user_keys": None,
+    "key_rotations": None,
+    "attachments": None,
+    "attachment_chunks": None,
+}
+# Small tables whose rows change in place; exported whole every time
+ALWAYS_FULL = {"user_keys", "key_rotations", "attachment_chunks"}
+# WITHOUT ROWID tables, and the primary key they are exported in order of
+KEY_ORDER = {"attachment_chunks": "attachment_id, chunk_index"}
+
+def archive_backup_path(dest_path):
+    """vault-backup.db.enc -> vault-backup_logs.db.enc, in the same directory"""
+    directory, filename = os.path.split(dest_path)
+    name, dot, extensions = filename.partition(".")
+    return os.path.join(directory, name + "_logs" + dot + extensions)
+
+def _copy_database(source, dest_path, pages, sleep, progress, encrypt):
+    partial_path = dest_path + ".partial"
+    copy_path = partial_path + ".db" if encrypt else partial_path
+    target = sqlite3.connect(copy_path)
+    try:
+        source.backup(target, pages=pages, progress=progress, sleep=sleep)
+    finally:
+        target.close()
+    if encrypt:
+        try:
+            with open(copy_path, "rb") as src, open(partial_path, "wb") as dst:
+                encrypt_file(master_cipher(), src, dst)
+        finally:
+            os.remove(copy_path)
+    os.replace(partial_path, dest_path)
+
+def snapshot(dest_path, pages=PAGES_PER_STEP, sleep=STEP_SLEEP, progress=None, encrypt=False):
+    """Copy the live database and its log archive without blocking writers for long
+
+    Each copy is written next to its destination and renamed into place, so
+    a failed backup never leaves a truncated file behind. With encrypt, each
+    copy is then streamed through the cipher into place and removed. Returns
+    the paths written.
+    """
+    flush_audit_log()
+    source = open_connection()
+    try:
+        _copy_database(source, dest_path, pages, sleep, progress, encrypt)
+    finally:
+        source.close()
+    paths = [dest_path]
+    # Copied second: logs archived in between then end up in both copies rather than neither
+    if os.path.exists(get_archive_path()):
+        archive = sqlite3.connect(get_archive_path())
+        try:
+            paths.append(archive_backup_path(dest_path))
+            _copy_database(archive, paths[-1], pages, sleep, progress, encrypt)
+        finally:
+            archive.close()
+    return paths
+
+def decrypt_backup(source_path, dest_path):
+    """Decrypt an encrypted snapshot or export file, a segment at a time"""
+    partial_path = dest_path + ".partial"
+    try:
+        with open(source_path, "rb") as src, open(partial_path, "wb") as dst:
+            decrypt_file(master_cipher(), src, dst)
+    except Exception:
+        # Never leave plaintext from a stream that failed to authenticate
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, dest_path)
+    return dest_path
+
+def _jsonable(value):
+    if isinstance(value, bytes):
+        return {"$b64": base64.b64encode(value).decode("ascii")}
+    return value
+
+def _export_table(conn, table, path, since=None, encrypt=False):
+    """Stream rows changed since the given marks into a JSONL file"""
+    mark_column = EXPORT_TABLES.get(table)
+    # Tables without a rowid are in ALWAYS_FULL, so they never need one as a mark
+    query = "SELECT {}, * FROM {}".format("0" if table in KEY_ORDER else "rowid", table)
+    params = ()
+    if since:
+        query += " WHERE rowid > ?"
+        params = (since.get("rowid", 0),)
+        if mark_column and since.get(mark_column):
+            # >= rather than >: timestamps only have second precision
+            query += " OR {} >= ?".format(mark_column)
+            params += (since[mark_column],)
+    query += " ORDER BY " + KEY_ORDER.get(table, "rowid")
+
+    cursor = conn.execute(query, params)
+    columns = [description[0] for description in cursor.description][1:]
+    marks = dict(since or {})
+    count = 0
+    with (open_encrypted(path, "w") if encrypt else open(path, "w", encoding="utf-8")) as f:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for rowid, *values in rows:
+                record = dict(zip(columns, map(_jsonable, values)))
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                marks["rowid"] = max(marks.get("rowid", 0), rowid)
+                if mark_column and record.get(mark_column):
+                    marks[mark_column] = max(marks.get(mark_column) or "", record[mark_column])
+            count += len(rows)
+    return count, marks
+
+def _load_manifest(dest_dir):
+    path = os.path.join(dest_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"exports": [], "high_water": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_manifest(dest_dir, manifest):
+    path = os.path.join(dest_dir, MANIFEST)
+    with open(path + ".partial", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".partial", path)
+
+def export(dest_dir, incremental=False, encrypt=False):
+    """Export every table as JSONL into a new directory under dest_dir
+
+    Incremental exports only contain rows added since the previous export
+    (and vault rows updated since then), found through the rowid and
+    updated_at high-water marks kept in dest_dir/manifest.json. Deletions
+    and edits to tables without updated_at are not captured; take a full
+    export now and then. Archived security log months are exported after
+    the main tables. With encrypt, each file is written as TABLE.jsonl.enc.
+    """
+    flush_audit_log()
+    os.makedirs(dest_dir, exist_ok=True)
+    manifest = _load_manifest(dest_dir)
+    incremental = incremental and bool(manifest["high_water"])
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+    name = "{:04d}-{}-{}".format(len(manifest["exports"]) + 1, "incremental" if incremental else "full", stamp)
+    export_dir = os.path.join(dest_dir, name)
+    os.makedirs(export_dir)
+
+    conn = open_connection()
+    counts = {}
+    high_water = {}
+    try:
+        tables = [(table, table) for table in EXPORT_TABLES]
+        if os.path.exists(get_archive_path()):
+            conn.execute("ATTACH DATABASE ? AS {}".format(ARCHIVE_SCHEMA), (get_archive_path(),))
+            tables += [(name, "{}.{}".format(ARCHIVE_SCHEMA, name)) for name in reversed(archive_partitions(conn))]
+        # One read transaction, so every table comes from the same snapshot
+        conn.execute("BEGIN")
+        for name, table in tables:
+            since = manifest["high_water"].get(name) if incremental and name not in ALWAYS_FULL else None
+            filename = name + ".jsonl" + (ENCRYPTED_SUFFIX if encrypt else "")
+            counts[name], high_water[name] = _export_table(
+                conn, table, os.path.join(export_dir, filename), since, encrypt
+            )
+        conn.rollback()
+    finally:
+        conn.close()
+
+    manifest["exports"].append({"name": name, "incremental": incremental, "encrypted": encrypt, "rows": counts})
+    manifest["high_water"] = high_water
+    _save_manifest(dest_dir, manifest)
+    return {"path": export_dir, "incremental": incremental, "encrypted": encrypt, "rows": counts}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Back up or export the vault database")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    snap = subcommands.add_parser("snapshot", help="online copy of the database file")
+    snap.add_argument("dest")
+    snap.add_argument("--pages", type=int, default=PAGES_PER_STEP)
+    snap.add_argument("--encrypt", action="store_true")
+
+    exp = subcommands.add_parser("export", help="JSONL export of every table")
+    exp.add_argument("dest_dir")
+    exp.add_argument("--incremental", action="store_true")
+    exp.add_argument("--encrypt", action="store_true")
+
+    dec = subcommands.add_parser("decrypt", help="decrypt an encrypted snapshot or export file")
+    dec.add_argument("source")
+    dec.add_argument("dest")
+
+    args = parser.parse_args(argv)
+    if args.command == "snapshot":
+        def progress(status, remaining, total):
+            # Padded, since the log archive is copied after the database on the same line
+            print("\r{}/{} pages copied".format(total - remaining, total).ljust(30), end="", flush=True)
+        paths = snapshot(args.dest, args.pages, progress=progress, encrypt=args.encrypt)
+        print("\nBackup written to {}".format(", ".join(paths)))
+    elif args.command == "decrypt":
+        print("Decrypted to {}".format(decrypt_backup(args.source, args.dest)))
+    else:
+        print(json.dumps(export(args.dest_dir, args.incremental, args.encrypt), indent=2))
+
+if __name__ == "__main__":
+    from database import close_db
+    try:
+        main()
+    finally:
+        close_db()
@@ -0,0 +1,547 @@
+"""Performance benchmarks for LifeVault
+
+Usage:
+    python benchmark.py startup [--runs N] [--output results.json]
+    python benchmark.py generate DEST.db [--users N] [--entries M] ...
+    python benchmark.py run [--db DEST.db] [--repeat N] [--output results.json]
+    python benchmark.py memory [--entries M] [--output results.json]
+    python benchmark.py formats [--entries M] [--output results.json]
+    python benchmark.py keys [--repeat N] [--output results.json]
+    python benchmark.py stream [--sizes MIB ...] [--output results.json]
+    python benchmark.py compare BASELINE.json CURRENT.json [--threshold 0.2]
+
+Every benchmark prints a JSON document so runs can be stored and compared
+over time. "run" builds a synthetic database in a temporary directory
+unless --db points at one made by "generate".
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import database
+import encryption
+from models import CATEGORIES, CATEGORY_KEYS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOCAL_MODULES = ("main", "ascii_ui", "auth", "vault", "emergency", "database", "encryption", "models")
+
+def summarize(samples):
+    """Reduce a list of timings in seconds to millisecond statistics"""
+    ms = sorted(sample * 1000 for sample in samples)
+    return {
+        "runs": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "median_ms": round(statistics.median(ms), 3),
+        "min_ms": round(ms[0], 3),
+        "max_ms": round(ms[-1], 3),
+    }
+
+def _run_python(code, cwd, extra_args=()):
+    env = dict(os.environ, PYTHONPATH=HERE, PYTHONDONTWRITEBYTECODE="1")
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, *extra_args, "-c", code],
+        cwd=cwd, env=env, check=True, capture_output=True, text=True
+    )
+    return time.perf_counter() - start, completed
+
+def _import_breakdown(module, cwd):
+    """Cumulative import time of this repo's modules, from -X importtime"""
+    _, completed = _run_python("import {}".format(module), cwd, ("-X", "importtime"))
+    breakdown = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        if name in LOCAL_MODULES:
+            breakdown[name] = int(cumulative) / 1000
+    return breakdown
+
+def bench_startup(runs=10, module="main"):
+    """Cold-start cost of importing the application in a fresh interpreter"""
+    with tempfile.TemporaryDirectory() as workdir:
+        # Interpreter start-up alone, so the import cost can be told apart
+        baseline = [_run_python("pass", workdir)[0] for _ in range(runs)]
+        samples = [_run_python("import {}".format(module), workdir)[0] for _ in range(runs)]
+        breakdown = _import_breakdown(module, workdir)
+        # Importing must not touch the database or the key file
+        touched = sorted(os.listdir(workdir))
+    return {
+        "module": module,
+        "interpreter": summarize(baseline),
+        "import": summarize(samples),
+        "import_overhead_ms": round(statistics.median(samples) * 1000 - statistics.median(baseline) * 1000, 3),
+        "module_cumulative_ms": breakdown,
+        "files_created": touched,
+    }
+
+WORDS = (
+    "blood type allergy penicillin insulin dosage clinic doctor appointment "
+    "account routing number branch policy premium insurer claim beneficiary "
+    "passport visa expiry embassy itinerary flight hotel booking reference "
+    "contract lawyer will deed notary trust power attorney estate "
+    "password login server token project office badge manager contact"
+).split()
+ACTIONS = ("login_success", "logout", "entries_viewed", "entries_searched", "entry_added",
+           "entry_edited", "entry_deleted", "emergency_access_granted", "emergency_access_failed")
+SEARCH_TERM = "passport"
+TYPO_SEARCH_TERM = "pasport visa"
+
+def _sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+def _timestamp(rng, now, max_days):
+    moment = now - datetime.timedelta(seconds=rng.randint(0, max_days * 86400))
+    return moment.strftime(database.TIMESTAMP_FORMAT)
+
+def generate_dataset(path, users=10, entries=500, contacts=3, logs=100000, attempts=10000, seed=1):
+    """Build a synthetic vault database at path and return what was created
+
+    User i is "user{i}" with password "password{i}" and emergency PIN "1234".
+    Entry contents are real ciphertexts under each user's data key.
+    """
+    from auth import hash_password
+    from key_store import get_keyring
+
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    category_ids = [category["id"] for category in CATEGORIES.values()]
+    category_names = [category["name"] for category in CATEGORIES.values()]
+    database.init_db(path)
+    conn = database.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (username, password_hash, email, emergency_pin) VALUES (?, ?, ?, ?)",
+            [("user{}".format(i), hash_password("password{}".format(i)), "user{}@example.com".format(i),
+              hash_password("1234")) for i in range(1, users + 1)]
+        )
+        user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+        for user_id in user_ids:
+            keyring = get_keyring(user_id)
+            rows = []
+            for n in range(entries):
+                created = _timestamp(rng, now, 730)
+                rows.append((user_id, rng.choice(category_ids), "{} {}".format(_sentence(rng, 1, 3), n),
+                             keyring.encrypt_text(_sentence(rng, 5, 60)), created, created))
+            conn.executemany(
+                "INSERT INTO vault (user_id, category_id, title, encrypted_data, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.executemany(
+                "INSERT INTO emergency_contacts (user_id, name, phone, email, allowed_categories) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, "Contact {}".format(n), "555-01{:02d}".format(n), None,
+                  ",".join(rng.sample(category_names, rng.randint(1, 3)))) for n in range(contacts)]
+            )
+        conn.executemany(
+            "INSERT INTO security_logs (user_id, action, ip_address, timestamp, details) VALUES (?, ?, ?, ?, ?)",
+            ((rng.choice(user_ids), rng.choice(ACTIONS), "localhost", _timestamp(rng, now, 25), "")
+             for _ in range(logs))
+        )
+        conn.executemany(
+            "INSERT INTO failed_attempts (user_id, attempt_type, ip_address, timestamp) VALUES (?, ?, ?, ?)",
+            ((rng.choice(user_ids), rng.choice(("login", "pin")), "localhost", _timestamp(rng, now, 1))
+             for _ in range(attempts))
+        )
+    return {"users": users, "entries_per_user": entries, "contacts_per_user": contacts,
+            "security_logs": logs, "failed_attempts": attempts, "seed": seed}
+
+def time_call(func, repeat=5, number=1):
+    """Time `repeat` samples of `number` calls each, after one warm-up call"""
+    func()  # warm-up, so one-off loads don't skew the first sample
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return summarize(samples)
+
+def bench_core_paths(repeat=5):
+    """Time the hot application paths against the configured database"""
+    from auth import find_user, check_login, verify_emergency_pin, collect_emergency_data
+    from vault import VaultManager, load_ciphertexts
+    from parallel_decrypt import decrypt_many
+    from key_store import get_keyring
+
+    user = find_user("user1")
+    if user is None:
+        raise SystemExit("database has no user1; create it with 'benchmark.py generate'")
+    manager = VaultManager()
+    manager.load_user_data(user.id)
+    load_ciphertexts(manager.data_entries)
+    ciphertexts = [entry.encrypted_data for entry in manager.data_entries]
+
+    def emergency_access():
+        verify_emergency_pin(user, "1234")
+        collect_emergency_data(user.id)
+
+    results = {
+        "load_user_data": time_call(lambda: VaultManager().load_user_data(user.id), repeat),
+        "search_entries": time_call(lambda: manager.find_entries(SEARCH_TERM), repeat),
+        "ranked_search": time_call(lambda: manager.rank_entries(TYPO_SEARCH_TERM), repeat, number=100),
+        "decrypt_all_entries": time_call(lambda: decrypt_many(ciphertexts, get_keyring(user.id)), repeat),
+        "get_statistics": time_call(manager.compute_statistics, repeat),
+        "login": time_call(lambda: check_login("user1", "password1"), repeat),
+        "emergency_access": time_call(emergency_access, repeat),
+        "is_account_locked": time_call(lambda: database.is_account_locked(user.id, "pin"), repeat, number=1000),
+    }
+    database.flush_audit_log()
+    return results
+
+class LegacyVaultData:
+    """VaultData as it was before __slots__, for bench_memory"""
+
+    def __init__(self, id, user_id, category, title, encrypted_data, created_at, updated_at, decrypt_func):
+        self.id = id
+        self.user_id = user_id
+        self.category = category
+        self.title = title
+        self.encrypted_data = encrypted_data
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.decrypt_func = decrypt_func
+
+def _retained_bytes(build):
+    """Python memory still held by build()'s result once it returns"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return retained, len(result)
+
+def bench_memory(user_id):
+    """Memory held by one user's loaded entries: per-entry __dict__ against the slotted layout
+
+    Both layouts hold the same listing fields and no ciphertext, as listings
+    have since ciphertexts became lazy. What holding every ciphertext as well
+    would add is reported on its own, as ciphertext_bytes_per_entry.
+    """
+    from vault import iter_user_entries
+    from key_store import decrypt_for_user
+
+    def legacy(with_ciphertext):
+        rows = database.fetch_all(
+            "SELECT id, user_id, category_id, title, {}, created_at, updated_at FROM vault WHERE user_id = ? ORDER BY id".format(
+                "encrypted_data" if with_ciphertext else "NULL"),
+            (user_id,)
+        )
+        return [LegacyVaultData(id_, uid, CATEGORIES[CATEGORY_KEYS[cat]]["name"], title, enc, created, updated,
+                                decrypt_for_user)
+                for id_, uid, cat, title, enc, created, updated in rows]
+
+    def current():
+        return {entry.id: entry for entry in iter_user_entries(user_id)}
+
+    dict_bytes, count = _retained_bytes(lambda: legacy(False))
+    with_ciphertext_bytes, _ = _retained_bytes(lambda: legacy(True))
+    slots_bytes, _ = _retained_bytes(current)
+    per_entry = max(count, 1)
+    return {
+        "entries": count,
+        "dict_bytes": dict_bytes,
+        "slots_bytes": slots_bytes,
+        "dict_bytes_per_entry": round(dict_bytes / per_entry, 1),
+        "slots_bytes_per_entry": round(slots_bytes / per_entry, 1),
+        "reduction": round(1 - slots_bytes / dict_bytes, 3) if dict_bytes else 0.0,
+        "ciphertext_bytes_per_entry": round((with_ciphertext_bytes - dict_bytes) / per_entry, 1),
+    }
+
+def _stored_bytes(values):
+    """Size of an in-memory SQLite table holding values, in pages"""
+    import sqlite3
+
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, encrypted_data TEXT)")
+        conn.executemany("INSERT INTO t (encrypted_data) VALUES (?)", ((value,) for value in values))
+        conn.commit()
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        return page_count * conn.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        conn.close()
+
+def bench_formats(entries=5000, repeat=5, seed=1):
+    """Fernet TEXT tokens against the binary AES-GCM format: stored size and throughput
+
+    The short entries here are below the compression threshold; "large"
+    shows what compression does for long ones.
+    """
+    from cryptography.fernet import Fernet
+
+    rng = random.Random(seed)
+    contents = [_sentence(rng, 5, 60) for _ in range(entries)]
+    key = Fernet.generate_key()
+    fernet = Fernet(key)
+    cipher = encryption.DataCipher([(1, key)])
+    fernet_tokens = [fernet.encrypt(text.encode()).decode() for text in contents]
+    blobs = [cipher.encrypt_text(text) for text in contents]
+
+    fernet_bytes, blob_bytes = _stored_bytes(fernet_tokens), _stored_bytes(blobs)
+    plaintext_bytes = sum(len(text.encode()) for text in contents)
+    return {
+        "entries": entries,
+        "plaintext_bytes_per_entry": round(plaintext_bytes / entries, 1),
+        "fernet_bytes_per_entry": round(sum(map(len, fernet_tokens)) / entries, 1),
+        "binary_bytes_per_entry": round(sum(map(len, blobs)) / entries, 1),
+        "fernet_table_bytes": fernet_bytes,
+        "binary_table_bytes": blob_bytes,
+        "table_reduction": round(1 - blob_bytes / fernet_bytes, 3),
+        "timings": {
+            "fernet_encrypt_all": time_call(lambda: [fernet.encrypt(text.encode()).decode() for text in contents], repeat),
+            "binary_encrypt_all": time_call(lambda: [cipher.encrypt_text(text) for text in contents], repeat),
+            "fernet_decrypt_all": time_call(lambda: [fernet.decrypt(token.encode()).decode() for token in fernet_tokens], repeat),
+            "binary_decrypt_all": time_call(lambda: [cipher.decrypt_text(blob) for blob in blobs], repeat),
+        },
+        "large": bench_compression(cipher, rng, max(1, entries // 10), repeat),
+    }
+
+def bench_compression(cipher, rng, entries, repeat=5):
+    """Long entries (a few KiB of text) stored raw and compressed before encryption"""
+    contents = [_sentence(rng, 400, 1500).encode() for _ in range(entries)]
+    raw = [cipher.encrypt(data, compress=False) for data in contents]
+    packed = [cipher.encrypt(data) for data in contents]
+    raw_bytes, packed_bytes = _stored_bytes(raw), _stored_bytes(packed)
+    return {
+        "entries": entries,
+        "plaintext_bytes_per_entry": round(sum(map(len, contents)) / entries, 1),
+        "raw_bytes_per_entry": round(sum(map(len, raw)) / entries, 1),
+        "compressed_bytes_per_entry": round(sum(map(len, packed)) / entries, 1),
+        "raw_table_bytes": raw_bytes,
+        "compressed_table_bytes": packed_bytes,
+        "table_reduction": round(1 - packed_bytes / raw_bytes, 3),
+        "timings": {
+            "raw_encrypt_all": time_call(lambda: [cipher.encrypt(data, compress=False) for data in contents], repeat),
+            "compressed_encrypt_all": time_call(lambda: [cipher.encrypt(data) for data in contents], repeat),
+            "raw_decrypt_all": time_call(lambda: [cipher.decrypt(token) for token in raw], repeat),
+            "compressed_decrypt_all": time_call(lambda: [cipher.decrypt(token) for token in packed], repeat),
+        },
+    }
+
+def bench_key_fetch(repeat=20):
+    """Cold master key fetches from the key file and from a key agent on a local socket"""
+    import threading
+    from key_agent import KeyAgent, send_command
+    from key_provider import FileKeyProvider, AgentKeyProvider
+
+    with tempfile.TemporaryDirectory() as workdir:
+        key_file = os.path.join(workdir, "benchmark.key")
+        agent = KeyAgent(key_file, idle_timeout=60)
+        thread = threading.Thread(target=agent.serve, daemon=True)
+        thread.start()
+        while not os.path.exists(agent.socket_path):
+            time.sleep(0.01)
+
+        def fetch(make_provider):
+            provider = make_provider()
+            provider.master_key()
+            return provider.stats.total
+
+        def samples(make_provider):
+            fetch(make_provider)  # warm-up
+            return summarize([fetch(make_provider) for _ in range(repeat)])
+
+        try:
+            return {
+                "file": samples(lambda: FileKeyProvider(key_file)),
+                "agent": samples(lambda: AgentKeyProvider(agent.socket_path, FileKeyProvider(key_file))),
+                "agent_requests": agent.requests,
+            }
+        finally:
+            send_command(key_file, "STOP")
+            thread.join(5)
+
+def _peak_bytes(func):
+    """Peak Python memory allocated while func runs, and how long it took"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, elapsed
+
+def bench_streaming(sizes_mib=(4, 16, 64)):
+    """Peak memory of whole-payload encryption against the segmented stream API"""
+    from cryptography.fernet import Fernet
+
+    cipher = encryption.DataCipher([(1, Fernet.generate_key())])
+    block = os.urandom(encryption.SEGMENT_SIZE)
+
+    def source(size):
+        # Generated as it's read, so the payload itself is never in memory
+        for _ in range(size // len(block)):
+            yield block
+
+    def round_trip_stream(size):
+        ciphertext = encryption.encrypt_stream(cipher, source(size))
+        for _ in encryption.decrypt_stream(cipher, ciphertext):
+            pass
+
+    def round_trip_whole(size):
+        cipher.decrypt(cipher.encrypt(b"".join(source(size)), compress=False))
+
+    results = {}
+    for mib in sizes_mib:
+        size = mib * 1024 * 1024
+        whole_peak, whole_seconds = _peak_bytes(lambda: round_trip_whole(size))
+        stream_peak, stream_seconds = _peak_bytes(lambda: round_trip_stream(size))
+        results["{}MiB".format(mib)] = {
+            "whole_peak_bytes": whole_peak,
+            "stream_peak_bytes": stream_peak,
+            "whole_seconds": round(whole_seconds, 3),
+            "stream_seconds": round(stream_seconds, 3),
+        }
+    return results
+
+def run_suite(db_path=None, repeat=5, **dataset):
+    """Generate (or reuse) a database and time the core paths against it"""
+    with tempfile.TemporaryDirectory() as workdir:
+        # Never touch the real key: benchmark data gets its own
+        encryption.KEY_FILE = os.path.join(os.path.dirname(db_path) if db_path else workdir, "benchmark.key")
+        if db_path and os.path.exists(db_path):
+            database.init_db(db_path)
+            info = {"database": db_path}
+        else:
+            started = time.perf_counter()
+            info = generate_dataset(db_path or os.path.join(workdir, "benchmark.db"), **dataset)
+            info["generate_seconds"] = round(time.perf_counter() - started, 3)
+        try:
+            timings = bench_core_paths(repeat)
+            from auth import find_user
+            return {"dataset": info, "timings": timings, "memory": bench_memory(find_user("user1").id),
+                    "formats": bench_formats(repeat=repeat), "key_fetch": encryption.key_fetch_stats()}
+        finally:
+            database.close_db()
+
+def compare(baseline, current, threshold=0.2):
+    """Timings that got slower than baseline by more than threshold (a fraction)"""
+    regressions = {}
+    old_timings = baseline["results"].get("timings", {})
+    for name, timing in current["results"].get("timings", {}).items():
+        if name not in old_timings:
+            continue
+        old, new = old_timings[name]["median_ms"], timing["median_ms"]
+        if old and (new - old) / old > threshold:
+            regressions[name] = {"baseline_ms": old, "current_ms": new, "change": round((new - old) / old, 3)}
+    return regressions
+
+def report(name, results, output=None):
+    document = {
+        "benchmark": name,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(document, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return document
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="LifeVault benchmarks")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    startup = subcommands.add_parser("startup", help="time a cold import of main.py")
+    startup.add_argument("--runs", type=int, default=10)
+    startup.add_argument("--module", default="main")
+    startup.add_argument("--output")
+
+    generate = subcommands.add_parser("generate", help="build a synthetic database")
+    run = subcommands.add_parser("run", help="time the core paths")
+    for sub in (generate, run):
+        sub.add_argument("--users", type=int, default=10)
+        sub.add_argument("--entries", type=int, default=500)
+        sub.add_argument("--contacts", type=int, default=3)
+        sub.add_argument("--logs", type=int, default=100000)
+        sub.add_argument("--attempts", type=int, default=10000)
+        sub.add_argument("--seed", type=int, default=1)
+    generate.add_argument("db")
+    run.add_argument("--db")
+    run.add_argument("--repeat", type=int, default=5)
+    run.add_argument("--output")
+
+    memory = subcommands.add_parser("memory", help="memory held by one user's loaded entries")
+    memory.add_argument("--entries", type=int, default=20000)
+    memory.add_argument("--seed", type=int, default=1)
+    memory.add_argument("--output")
+
+    formats = subcommands.add_parser("formats", help="stored size and speed of the ciphertext formats")
+    formats.add_argument("--entries", type=int, default=5000)
+    formats.add_argument("--repeat", type=int, default=5)
+    formats.add_argument("--seed", type=int, default=1)
+    formats.add_argument("--output")
+
+    keys = subcommands.add_parser("keys", help="master key fetch latency, file against agent")
+    keys.add_argument("--repeat", type=int, default=20)
+    keys.add_argument("--output")
+
+    stream = subcommands.add_parser("stream", help="peak memory of whole against streaming encryption")
+    stream.add_argument("--sizes", type=int, nargs="+", default=[4, 16, 64], help="payload sizes in MiB")
+    stream.add_argument("--output")
+
+    comparison = subcommands.add_parser("compare", help="report regressions between two runs")
+    comparison.add_argument("baseline")
+    comparison.add_argument("current")
+    comparison.add_argument("--threshold", type=float, default=0.2)
+
+    args = parser.parse_args(argv)
+    dataset = {}
+    if args.command in ("generate", "run"):
+        dataset = dict(users=args.users, entries=args.entries, contacts=args.contacts,
+                       logs=args.logs, attempts=args.attempts, seed=args.seed)
+    if args.command == "startup":
+        report("startup", bench_startup(args.runs, args.module), args.output)
+    elif args.command == "generate":
+        encryption.KEY_FILE = os.path.join(os.path.dirname(os.path.abspath(args.db)), "benchmark.key")
+        try:
+            print(json.dumps(generate_dataset(args.db, **dataset), indent=2))
+        finally:
+            database.close_db()
+    elif args.command == "run":
+        report("core_paths", run_suite(args.db, args.repeat, **dataset), args.output)
+    elif args.command == "memory":
+        with tempfile.TemporaryDirectory() as workdir:
+            encryption.KEY_FILE = os.path.join(workdir, "benchmark.key")
+            generate_dataset(os.path.join(workdir, "memory.db"), users=1, entries=args.entries,
+                             contacts=0, logs=0, attempts=0, seed=args.seed)
+            try:
+                report("memory", bench_memory(1), args.output)
+            finally:
+                database.close_db()
+    elif args.command == "formats":
+        report("formats", bench_formats(args.entries, args.repeat, args.seed), args.output)
+    elif args.command == "keys":
+        report("keys", bench_key_fetch(args.repeat), args.output)
+    elif args.command == "stream":
+        report("stream", bench_streaming(args.sizes), args.output)
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        print(json.dumps({"threshold": args.threshold, "regressions": regressions}, indent=2))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,112 +1,758 @@
 import sqlite3
 import datetime
+import threading
+import atexit
+import time
+from collections import deque
+from contextlib import contextmanager
 
-conn = sqlite3.connect("vault.db")
-cursor = conn.cursor()
-
-# Users table for authentication
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE NOT NULL,
-    password_hash TEXT NOT NULL,
-    email TEXT,
-    emergency_pin TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-''')
-
-# Vault table with user association
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS vault (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    category TEXT NOT NULL,
-    title TEXT NOT NULL,
-    encrypted_data TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users (id)
-)
-''')
-
-# Emergency contacts with user association
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS emergency_contacts (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    name TEXT NOT NULL,
-    phone TEXT NOT NULL,
-    email TEXT,
-    allowed_categories TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users (id)
-)
-''')
-
-# Security logs for failed attempts
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS security_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    action TEXT NOT NULL,
-    ip_address TEXT,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    details TEXT,
-    FOREIGN KEY (user_id) REFERENCES users (id)
-)
-''')
-
-# Failed PIN attempts tracking
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS failed_attempts (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    attempt_type TEXT NOT NULL,
-    ip_address TEXT,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users (id)
+DB_PATH = "vault.db"
+
+# Applied to every new connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
 )
-''')
 
-conn.commit()
+class ConnectionManager:
+    """Hands out one SQLite connection per thread
 
-def get_cursor():
-    return cursor
+    Nothing is opened until the first query, and the schema is checked
+    (and migrated if needed) once, on the first connection.
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._schema_ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def open_connection(self):
+        """A private connection for long-running jobs, outside the per-thread pool"""
+        self.get_connection()  # makes sure the schema is current
+        return self._connect()
+
+    def get_connection(self):
+        """Return the calling thread's connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+                if not self._schema_ready:
+                    migrate(conn)
+                    self._schema_ready = True
+        return conn
+
+    def close_all(self):
+        """Close every connection opened by any thread"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+_manager = ConnectionManager()
+
+def init_db(path=None):
+    """Point the module at a database file and make sure its schema is current
+
+    Calling this is optional: the first query does the same thing lazily.
+    """
+    global _manager
+    if path is not None and path != _manager.path:
+        _manager.close_all()
+        _manager = ConnectionManager(path)
+    get_connection()
 
 def get_connection():
-    return conn
+    return _manager.get_connection()
+
+def get_database_path():
+    return _manager.path
+
+def open_connection():
+    return _manager.open_connection()
+
+def get_cursor():
+    """Return a fresh cursor on the calling thread's connection"""
+    return get_connection().cursor()
+
+@contextmanager
+def transaction():
+    """Run a block in one transaction on the calling thread's connection"""
+    conn = get_connection()
+    with conn:
+        yield conn
+
+def execute(sql, params=()):
+    """Run a single write statement in its own transaction and return its cursor"""
+    with transaction() as conn:
+        return conn.execute(sql, params)
+
+def fetch_one(sql, params=()):
+    return get_connection().execute(sql, params).fetchone()
+
+def fetch_all(sql, params=()):
+    return get_connection().execute(sql, params).fetchall()
+
+def get_vault_version(user_id, conn=None):
+    """Bumped by a trigger on every insert, update or delete of the user's entries"""
+    row = (conn or get_connection()).execute(
+        "SELECT version FROM vault_versions WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    return row[0] if row else 0
+
+# Each entry upgrades the schema by one version. PRAGMA user_version records
+# how many have been applied, so existing databases are upgraded in place.
+MIGRATIONS = [
+    # 1: base tables
+    (
+        # Users table for authentication
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            email TEXT,
+            emergency_pin TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+
+        # Vault table with user association
+        '''
+        CREATE TABLE IF NOT EXISTS vault (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            title TEXT NOT NULL,
+            encrypted_data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+
+        # Emergency contacts with user association
+        '''
+        CREATE TABLE IF NOT EXISTS emergency_contacts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            email TEXT,
+            allowed_categories TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+
+        # Security logs for failed attempts
+        '''
+        CREATE TABLE IF NOT EXISTS security_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action TEXT NOT NULL,
+            ip_address TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            details TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+
+        # Failed PIN attempts tracking
+        '''
+        CREATE TABLE IF NOT EXISTS failed_attempts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            attempt_type TEXT NOT NULL,
+            ip_address TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+    ),
+    # 2: indexes for the per-user lookups on every hot path
+    (
+        "CREATE INDEX IF NOT EXISTS idx_vault_user ON vault (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_failed_attempts_lookup ON failed_attempts (user_id, attempt_type, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_security_logs_user_time ON security_logs (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_emergency_contacts_user ON emergency_contacts (user_id)",
+    ),
+    # 3: lets the lockout tracker warm up and expire old attempts by time
+    (
+        "CREATE INDEX IF NOT EXISTS idx_failed_attempts_time ON failed_attempts (timestamp)",
+    ),
+    # 4: security log rotation and per-day summaries of compacted months
+    (
+        "CREATE INDEX IF NOT EXISTS idx_security_logs_time ON security_logs (timestamp)",
+        '''
+        CREATE TABLE IF NOT EXISTS security_log_summary (
+            user_id INTEGER,
+            day TEXT NOT NULL,
+            action TEXT NOT NULL,
+            event_count INTEGER NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_security_log_summary_user_day ON security_log_summary (user_id, day)",
+    ),
+    # 5: per-user vault version, bumped by every write, for cache validation
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS vault_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO vault_versions (user_id, version) SELECT DISTINCT user_id, 1 FROM vault",
+        '''
+        CREATE TRIGGER IF NOT EXISTS vault_version_insert AFTER INSERT ON vault BEGIN
+            INSERT INTO vault_versions (user_id, version) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS vault_version_update AFTER UPDATE ON vault BEGIN
+            INSERT INTO vault_versions (user_id, version) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS vault_version_moved AFTER UPDATE OF user_id ON vault
+        WHEN OLD.user_id != NEW.user_id BEGIN
+            UPDATE vault_versions SET version = version + 1 WHERE user_id = OLD.user_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS vault_version_delete AFTER DELETE ON vault BEGIN
+            UPDATE vault_versions SET version = version + 1 WHERE user_id = OLD.user_id;
+        END
+        ''',
+    ),
+    # 6: blind search index (see search_index.py)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS search_tokens (
+            user_id INTEGER NOT NULL,
+            token BLOB NOT NULL,
+            entry_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, token, entry_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_search_tokens_entry ON search_tokens (entry_id)",
+        "ALTER TABLE vault ADD COLUMN search_indexed INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_vault_unindexed ON vault (user_id) WHERE search_indexed = 0",
+        '''
+        CREATE TRIGGER IF NOT EXISTS search_tokens_delete AFTER DELETE ON vault BEGIN
+            DELETE FROM search_tokens WHERE entry_id = OLD.id;
+        END
+        ''',
+        # Marking an entry as indexed must not look like a change to its data
+        "DROP TRIGGER IF EXISTS vault_version_update",
+        '''
+        CREATE TRIGGER vault_version_update
+        AFTER UPDATE OF user_id, category, title, encrypted_data, updated_at ON vault BEGIN
+            INSERT INTO vault_versions (user_id, version) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+    ),
+    # 7: integer category ids (models.CATEGORIES[...]["id"]) instead of
+    # display strings. SQLite can't swap a column in place, so the table is
+    # rebuilt and its indexes and triggers are recreated
+    (
+        '''
+        CREATE TABLE vault_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            encrypted_data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            search_indexed INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        # Matches display names ("🏥 Medical"), keys and bare names exactly.
+        # Anything else (free text typed into the old edit prompt) goes to
+        # Other, with the text kept as a "[...]" prefix on the title
+        '''
+        INSERT INTO vault_new (id, user_id, category_id, title, encrypted_data, created_at, updated_at, search_indexed)
+        SELECT id, user_id, category_id,
+            CASE
+                WHEN category_id = 8 AND coalesce(lower(trim(category)), '') NOT IN ('📁 other', 'other', '')
+                THEN '[' || trim(category) || '] ' || title
+                ELSE title
+            END,
+            encrypted_data, created_at, updated_at, search_indexed
+        FROM (
+            SELECT *,
+                CASE
+                    WHEN lower(trim(category)) IN ('🏥 medical', 'medical') THEN 1
+                    WHEN lower(trim(category)) IN ('💰 financial', 'financial') THEN 2
+                    WHEN lower(trim(category)) IN ('🆘 emergency', 'emergency') THEN 3
+                    WHEN lower(trim(category)) IN ('👤 personal', 'personal') THEN 4
+                    WHEN lower(trim(category)) IN ('💼 work', 'work') THEN 5
+                    WHEN lower(trim(category)) IN ('⚖️ legal', 'legal') THEN 6
+                    WHEN lower(trim(category)) IN ('✈️ travel', 'travel') THEN 7
+                    ELSE 8
+                END AS category_id
+            FROM vault
+        )
+        ''',
+        # Keep AUTOINCREMENT from handing out ids of deleted entries again
+        "DELETE FROM sqlite_sequence WHERE name = 'vault_new'",
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'vault_new', seq FROM sqlite_sequence WHERE name = 'vault'",
+        "DROP TABLE vault",
+        "ALTER TABLE vault_new RENAME TO vault",
+        # Also serves every user_id-only lookup idx_vault_user used to
+        "CREATE INDEX idx_vault_user_category ON vault (user_id, category_id)",
+        "CREATE INDEX idx_vault_unindexed ON vault (user_id) WHERE search_indexed = 0",
+        '''
+        CREATE TRIGGER vault_version_insert AFTER INSERT ON vault BEGIN
+            INSERT INTO vault_versions (user_id, version) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER vault_version_update
+        AFTER UPDATE OF user_id, category_id, title, encrypted_data, updated_at ON vault BEGIN
+            INSERT INTO vault_versions (user_id, version) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER vault_version_moved AFTER UPDATE OF user_id ON vault
+        WHEN OLD.user_id != NEW.user_id BEGIN
+            UPDATE vault_versions SET version = version + 1 WHERE user_id = OLD.user_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER vault_version_delete AFTER DELETE ON vault BEGIN
+            UPDATE vault_versions SET version = version + 1 WHERE user_id = OLD.user_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER search_tokens_delete AFTER DELETE ON vault BEGIN
+            DELETE FROM search_tokens WHERE entry_id = OLD.id;
+        END
+        ''',
+        # Every user's entries changed shape
+        "UPDATE vault_versions SET version = version + 1",
+    ),
+    # 8: per-user counters kept by triggers, so statistics never scan
+    (
+        '''
+        CREATE TABLE vault_category_counts (
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            entry_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, category_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT INTO vault_category_counts (user_id, category_id, entry_count)
+        SELECT user_id, category_id, COUNT(*) FROM vault GROUP BY user_id, category_id
+        ''',
+        '''
+        CREATE TRIGGER vault_count_insert AFTER INSERT ON vault BEGIN
+            INSERT INTO vault_category_counts (user_id, category_id, entry_count) VALUES (NEW.user_id, NEW.category_id, 1)
+            ON CONFLICT (user_id, category_id) DO UPDATE SET entry_count = entry_count + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER vault_count_delete AFTER DELETE ON vault BEGIN
+            UPDATE vault_category_counts SET entry_count = entry_count - 1
+            WHERE user_id = OLD.user_id AND category_id = OLD.category_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER vault_count_update AFTER UPDATE OF user_id, category_id ON vault
+        WHEN OLD.user_id != NEW.user_id OR OLD.category_id != NEW.category_id BEGIN
+            UPDATE vault_category_counts SET entry_count = entry_count - 1
+            WHERE user_id = OLD.user_id AND category_id = OLD.category_id;
+            INSERT INTO vault_category_counts (user_id, category_id, entry_count) VALUES (NEW.user_id, NEW.category_id, 1)
+            ON CONFLICT (user_id, category_id) DO UPDATE SET entry_count = entry_count + 1;
+        END
+        ''',
+        '''
+        CREATE TABLE emergency_contact_counts (
+            user_id INTEGER PRIMARY KEY,
+            contact_count INTEGER NOT NULL
+        )
+        ''',
+        '''
+        INSERT INTO emergency_contact_counts (user_id, contact_count)
+        SELECT user_id, COUNT(*) FROM emergency_contacts GROUP BY user_id
+        ''',
+        '''
+        CREATE TRIGGER contact_count_insert AFTER INSERT ON emergency_contacts BEGIN
+            INSERT INTO emergency_contact_counts (user_id, contact_count) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET contact_count = contact_count + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER contact_count_delete AFTER DELETE ON emergency_contacts BEGIN
+            UPDATE emergency_contact_counts SET contact_count = contact_count - 1 WHERE user_id = OLD.user_id;
+        END
+        ''',
+        # The five most recently updated entries without sorting the vault
+        "CREATE INDEX idx_vault_user_updated ON vault (user_id, updated_at)",
+    ),
+    # 9: file attachments; chunk contents live in the blob store (see attachments.py)
+    (
+        '''
+        CREATE TABLE attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            entry_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            chunk_count INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (entry_id) REFERENCES vault (id)
+        )
+        ''',
+        "CREATE INDEX idx_attachments_entry ON attachments (entry_id)",
+        '''
+        CREATE TABLE attachment_chunks (
+            attachment_id INTEGER NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            blob_id TEXT NOT NULL,
+            PRIMARY KEY (attachment_id, chunk_index)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX idx_attachment_chunks_blob ON attachment_chunks (blob_id)",
+        '''
+        CREATE TRIGGER attachments_entry_delete AFTER DELETE ON vault BEGIN
+            DELETE FROM attachments WHERE entry_id = OLD.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER attachment_chunks_delete AFTER DELETE ON attachments BEGIN
+            DELETE FROM attachment_chunks WHERE attachment_id = OLD.id;
+        END
+        ''',
+    ),
+    # 10: per-user keys wrapped by the master key (see key_store.py)
+    (
+        '''
+        CREATE TABLE user_keys (
+            user_id INTEGER NOT NULL,
+            purpose TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            wrapped_key TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, purpose, version),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        # Existing data stays under the master key, recorded as data key
+        # version 0, until the rotation job below has re-encrypted it
+        '''
+        INSERT INTO user_keys (user_id, purpose, version, wrapped_key)
+        SELECT user_id, 'data', 0, NULL FROM vault
+        UNION SELECT user_id, 'data', 0, NULL FROM attachments
+        ''',
+        '''
+        CREATE TABLE key_rotations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            target_version INTEGER NOT NULL,
+            stage TEXT NOT NULL DEFAULT 'entries',
+            last_id INTEGER NOT NULL DEFAULT 0,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        "CREATE INDEX idx_key_rotations_pending ON key_rotations (finished_at, id)",
+        '''
+        INSERT INTO key_rotations (user_id, target_version)
+        SELECT user_id, 1 FROM user_keys WHERE version = 0
+        ''',
+        # Search tokens move to each user's index key; ensure_indexed rebuilds them
+        "DELETE FROM search_tokens",
+        "UPDATE vault SET search_indexed = 0",
+    ),
+    # 11: with idx_vault_user_updated around, the planner took that for the
+    # backfill query and scanned every row of the user; leading with
+    # search_indexed as well makes the partial index the obvious choice
+    (
+        "DROP INDEX IF EXISTS idx_vault_unindexed",
+        "CREATE INDEX idx_vault_unindexed ON vault (user_id, search_indexed) WHERE search_indexed = 0",
+    ),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """Apply any pending migrations in a single transaction"""
+    # A current database costs one PRAGMA read and no DDL
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Re-read under the write lock in case another process got here first
+        version = get_schema_version(conn)
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                conn.execute(statement)
+        conn.execute("PRAGMA user_version = {}".format(max(version, SCHEMA_VERSION)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def utc_timestamp(moment=None):
+    """Format a UTC time the same way as SQLite's CURRENT_TIMESTAMP"""
+    return (moment or utc_now()).strftime(TIMESTAMP_FORMAT)
+
+# Audit events that must be on disk before the caller carries on
+CRITICAL_ACTIONS = {
+    "account_locked",
+    "emergency_access_failed",
+    "emergency_access_granted",
+    "password_changed",
+    "emergency_pin_changed",
+}
+
+class AuditWriter:
+    """Queues audit rows in memory and writes them in batches, one commit per flush"""
+
+    def __init__(self, max_batch=100, flush_interval=1.0):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._security_logs = []
+        self._failed_attempts = []
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass  # rows were re-queued, retry on the next tick
+
+    def _enqueue(self, queue, row, sync):
+        with self._lock:
+            queue.append(row)
+            pending = len(self._security_logs) + len(self._failed_attempts)
+        if sync:
+            self.flush()
+            return
+        self._start()
+        if pending >= self.max_batch:
+            self._wakeup.set()
+
+    def log_event(self, user_id, action, ip_address, details, sync=False):
+        row = (user_id, action, ip_address, utc_timestamp(), details)
+        self._enqueue(self._security_logs, row, sync or action in CRITICAL_ACTIONS)
+
+    def log_failed_attempt(self, user_id, attempt_type, ip_address, sync=False):
+        row = (user_id, attempt_type, ip_address, utc_timestamp())
+        self._enqueue(self._failed_attempts, row, sync)
+
+    def flush(self):
+        """Write everything queued so far in a single transaction"""
+        with self._flush_lock:
+            with self._lock:
+                logs, self._security_logs = self._security_logs, []
+                attempts, self._failed_attempts = self._failed_attempts, []
+            if not logs and not attempts:
+                return
+            try:
+                with transaction() as conn:
+                    if logs:
+                        conn.executemany(
+                            "INSERT INTO security_logs (user_id, action, ip_address, timestamp, details) VALUES (?, ?, ?, ?, ?)",
+                            logs
+                        )
+                    if attempts:
+                        conn.executemany(
+                            "INSERT INTO failed_attempts (user_id, attempt_type, ip_address, timestamp) VALUES (?, ?, ?, ?)",
+                            attempts
+                        )
+            except Exception:
+                # Put the rows back in front of anything queued meanwhile
+                with self._lock:
+                    self._security_logs[:0] = logs
+                    self._failed_attempts[:0] = attempts
+                raise
+
+    def close(self):
+        """Stop the background flusher and drain the queue"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+_audit_writer = AuditWriter()
+atexit.register(_audit_writer.flush)
+
+def flush_audit_log():
+    _audit_writer.flush()
 
 def close_db():
-    conn.close()
+    _audit_writer.close()
+    _manager.close_all()
 
-def log_security_event(user_id, action, ip_address="localhost", details=""):
+def log_security_event(user_id, action, ip_address="localhost", details="", sync=False):
     """Log security events for audit trail"""
-    cursor.execute(
-        "INSERT INTO security_logs (user_id, action, ip_address, details) VALUES (?, ?, ?, ?)",
-        (user_id, action, ip_address, details)
-    )
-    conn.commit()
+    _audit_writer.log_event(user_id, action, ip_address, details, sync)
+
+LOCKOUT_THRESHOLD = 3
+LOCKOUT_WINDOW = datetime.timedelta(hours=2)
+# failed_attempts rows older than this are deleted; must cover LOCKOUT_WINDOW
+FAILED_ATTEMPT_RETENTION = datetime.timedelta(days=1)
+PURGE_INTERVAL = 3600  # seconds between expiry sweeps
+
+class LockoutTracker:
+    """Sliding windows of recent failed attempts per (user, attempt type)
+
+    Windows are warmed from failed_attempts on first use and every new
+    attempt is written through to the table, so lock checks never have to
+    scan it. Recording an attempt also re-reads that user's window, which
+    picks up failures logged by other processes in the meantime.
+    """
+
+    def __init__(self, threshold=LOCKOUT_THRESHOLD, window=LOCKOUT_WINDOW,
+                 retention=FAILED_ATTEMPT_RETENTION, purge_interval=PURGE_INTERVAL):
+        self.threshold = threshold
+        self.window = window
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._warmed = False
+        self._last_purge = None
+
+    def _ensure_warm(self):
+        if self._warmed:
+            return
+        with self._lock:
+            if self._warmed:
+                return
+            cutoff = utc_timestamp(utc_now() - self.window)
+            rows = fetch_all(
+                "SELECT user_id, attempt_type, timestamp FROM failed_attempts WHERE timestamp > ? ORDER BY timestamp",
+                (cutoff,)
+            )
+            for user_id, attempt_type, timestamp in rows:
+                self._windows.setdefault((user_id, attempt_type), deque()).append(
+                    datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+                )
+            self._warmed = True
+        self._maybe_purge()
+
+    def _reload(self, user_id, attempt_type):
+        cutoff = utc_timestamp(utc_now() - self.window)
+        rows = fetch_all(
+            """SELECT timestamp FROM failed_attempts
+               WHERE user_id = ? AND attempt_type = ? AND timestamp > ?
+               ORDER BY timestamp""",
+            (user_id, attempt_type, cutoff)
+        )
+        with self._lock:
+            self._windows[(user_id, attempt_type)] = deque(
+                datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT) for (timestamp,) in rows
+            )
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if self._last_purge is not None and now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        cutoff = utc_timestamp(utc_now() - max(self.retention, self.window))
+        execute("DELETE FROM failed_attempts WHERE timestamp < ?", (cutoff,))
+
+    def _recent(self, user_id, attempt_type):
+        """Drop expired attempts from the front of the window and return it"""
+        self._ensure_warm()
+        with self._lock:
+            window = self._windows.get((user_id, attempt_type))
+            if window is None:
+                return ()
+            cutoff = utc_now() - self.window
+            while window and window[0] <= cutoff:
+                window.popleft()
+            if not window:
+                del self._windows[(user_id, attempt_type)]
+            return window
+
+    def record(self, user_id, attempt_type, ip_address="localhost"):
+        self._ensure_warm()
+        _audit_writer.log_failed_attempt(user_id, attempt_type, ip_address, sync=True)
+        self._reload(user_id, attempt_type)
+        self._maybe_purge()
+
+    def count(self, user_id, attempt_type, hours=None):
+        """Failed attempts in the last N hours, from memory when the window covers it"""
+        if hours is not None and datetime.timedelta(hours=hours) > self.window:
+            return fetch_one(
+                """SELECT COUNT(*) FROM failed_attempts
+                   WHERE user_id = ? AND attempt_type = ?
+                   AND timestamp > datetime('now', '-{} hours')""".format(hours),
+                (user_id, attempt_type)
+            )[0]
+        window = self._recent(user_id, attempt_type)
+        if hours is None:
+            return len(window)
+        cutoff = utc_now() - datetime.timedelta(hours=hours)
+        return sum(1 for moment in list(window) if moment > cutoff)
+
+    def is_locked(self, user_id, attempt_type):
+        return len(self._recent(user_id, attempt_type)) >= self.threshold
+
+_lockout = LockoutTracker()
 
 def get_failed_attempts(user_id, attempt_type, hours=2):
     """Get failed attempts in the last N hours"""
-    cursor.execute(
-        """SELECT COUNT(*) FROM failed_attempts 
-           WHERE user_id = ? AND attempt_type = ? 
-           AND timestamp > datetime('now', '-{} hours')""".format(hours),
-        (user_id, attempt_type)
-    )
-    return cursor.fetchone()[0]
+    return _lockout.count(user_id, attempt_type, hours)
 
 def log_failed_attempt(user_id, attempt_type, ip_address="localhost"):
     """Log a failed attempt"""
-    cursor.execute(
-        "INSERT INTO failed_attempts (user_id, attempt_type, ip_address) VALUES (?, ?, ?)",
-        (user_id, attempt_type, ip_address)
-    )
-    conn.commit()
+    _lockout.record(user_id, attempt_type, ip_address)
 
 def is_account_locked(user_id, attempt_type="pin"):
     """Check if account is locked due to too many failed attempts"""
-    failed_count = get_failed_attempts(user_id, attempt_type)
-    return failed_count >= 3  # Lock after 3 failed attempts
\ No newline at end of file
+    return _lockout.is_locked(user_id, attempt_type)
\ No newline at end of file
@@ -1,11 +1,24 @@
-from database import get_cursor, get_connection, log_security_event
+from database import execute, fetch_one, fetch_all, log_security_event
 from models import EmergencyContact, CATEGORIES
 from ascii_ui import print_error, print_success, print_info, print_contact_info, get_user_choice, print_category_menu, refresh_screen
 
+def fetch_emergency_contacts(user_id):
+    """Emergency contacts for a user"""
+    contacts_data = fetch_all(
+        "SELECT id, name, phone, email, allowed_categories, created_at FROM emergency_contacts WHERE user_id = ?",
+        (user_id,)
+    )
+    return [
+        EmergencyContact(contact_id, user_id, name, phone, email, allowed_categories, created_at)
+        for contact_id, name, phone, email, allowed_categories, created_at in contacts_data
+    ]
+
+def count_emergency_contacts(user_id):
+    row = fetch_one("SELECT contact_count FROM emergency_contact_counts WHERE user_id = ?", (user_id,))
+    return row[0] if row else 0
+
 class EmergencyManager:
     def __init__(self):
-        self.cursor = get_cursor()
-        self.conn = get_connection()
         self.current_user_id = None
 
     def set_current_user(self, user_id):
@@ -56,11 +69,10 @@ class EmergencyManager:
         
         # Save contact
         allowed_categories_str = ",".join(allowed_categories)
-        self.cursor.execute(
+        execute(
             "INSERT INTO emergency_contacts (user_id, name, phone, email, allowed_categories) VALUES (?, ?, ?, ?, ?)", 
             (self.current_user_id, name, phone, email, allowed_categories_str)
         )
-        self.conn.commit()
         
         log_security_event(self.current_user_id, "emergency_contact_added", details=f"Contact: {name}")
         print_success("Emergency contact added successfully!")
@@ -73,11 +85,10 @@ class EmergencyManager:
             return False
 
         refresh_screen()
-        self.cursor.execute(
+        contacts_data = fetch_all(
             "SELECT id, name, phone, email, allowed_categories, created_at FROM emergency_contacts WHERE user_id = ?",
             (self.current_user_id,)
         )
-        contacts_data = self.cursor.fetchall()
         
         if not contacts_data:
             print_info("No emergency contacts found.")
@@ -100,11 +111,10 @@ class EmergencyManager:
             return False
 
         # Get contacts
-        self.cursor.execute(
+        contacts = fetch_all(
             "SELECT id, name, phone FROM emergency_contacts WHERE user_id = ?",
             (self.current_user_id,)
         )
-        contacts = self.cursor.fetchall()
         
         if not contacts:
             print_info("No emergency contacts to delete.")
@@ -127,8 +137,7 @@ class EmergencyManager:
             return False
         
         # Delete contact
-        self.cursor.execute("DELETE FROM emergency_contacts WHERE id = ?", (contact_id,))
-        self.conn.commit()
+        execute("DELETE FROM emergency_contacts WHERE id = ?", (contact_id,))
         
         log_security_event(self.current_user_id, "emergency_contact_deleted", details=f"Contact: {name}")
         print_success("Emergency contact deleted successfully!")
@@ -141,11 +150,10 @@ class EmergencyManager:
             return False
 
         # Get contacts
-        self.cursor.execute(
+        contacts = fetch_all(
             "SELECT id, name, phone, email, allowed_categories FROM emergency_contacts WHERE user_id = ?",
             (self.current_user_id,)
         )
-        contacts = self.cursor.fetchall()
         
         if not contacts:
             print_info("No emergency contacts to edit.")
@@ -178,11 +186,10 @@ class EmergencyManager:
             new_email = email
         
         # Update contact
-        self.cursor.execute(
+        execute(
             "UPDATE emergency_contacts SET name = ?, phone = ?, email = ? WHERE id = ?",
             (new_name, new_phone, new_email, contact_id)
         )
-        self.conn.commit()
         
         log_security_event(self.current_user_id, "emergency_contact_edited", details=f"Contact: {name} -> {new_name}")
         print_success("Emergency contact updated successfully!")
@@ -221,13 +228,4 @@ class EmergencyManager:
 
     def get_user_emergency_contacts(self, user_id):
         """Get emergency contacts for a specific user"""
-        self.cursor.execute(
-            "SELECT id, name, phone, email, allowed_categories, created_at FROM emergency_contacts WHERE user_id = ?",
-            (user_id,)
-        )
-        contacts_data = self.cursor.fetchall()
-        
-        return [
-            EmergencyContact(contact_id, user_id, name, phone, email, allowed_categories, created_at)
-            for contact_id, name, phone, email, allowed_categories, created_at in contacts_data
-        ]
\ No newline at end of file
+        return fetch_emergency_contacts(user_id)
\ No newline at end of file
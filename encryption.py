@@ -1,22 +1,432 @@
-from cryptography.fernet import Fernet
 import os
+import base64
+import io
+import hmac
+import hashlib
+import struct
+import threading
+import zlib
+
+from key_provider import default_provider
 
 KEY_FILE = 'secret.key'
 
+_provider = None
+_custom_provider = False
+_fernet = None
+_key_lock = threading.RLock()
+
+def get_key_provider():
+    """The provider of the master key; by default chosen for KEY_FILE on first use"""
+    global _provider
+    if _provider is None:
+        with _key_lock:
+            if _provider is None:
+                _provider = default_provider(KEY_FILE)
+    return _provider
+
+def set_key_provider(provider):
+    """Use provider for the master key from now on; None goes back to the default"""
+    global _provider, _custom_provider, _fernet
+    with _key_lock:
+        _provider = provider
+        _custom_provider = provider is not None
+        _fernet = None
+
+def key_fetch_stats():
+    return get_key_provider().stats.as_dict()
+
+def get_master_key():
+    """Load the key on first use rather than at import time"""
+    return get_key_provider().master_key()
+
 def load_key():
-    if not os.path.exists(KEY_FILE):
-        key = Fernet.generate_key()
-        with open(KEY_FILE, 'wb') as f:
-            f.write(key)
-    else:
-        with open(KEY_FILE, 'rb') as f:
-            key = f.read()
-    return Fernet(key)
+    from cryptography.fernet import Fernet
+
+    return Fernet(get_master_key())
+
+def get_fernet():
+    global _fernet
+    if _fernet is None:
+        with _key_lock:
+            if _fernet is None:
+                _fernet = load_key()
+    return _fernet
+
+def reset_master_key():
+    """Forget the cached master key, e.g. after KEY_FILE was replaced"""
+    global _provider, _fernet
+    with _key_lock:
+        if _provider is not None:
+            _provider.forget()
+            if not _custom_provider:
+                # Chosen again on next use, in case KEY_FILE or the agent changed
+                _provider = None
+        _fernet = None
+
+def read_pending_key():
+    """The master key a rotation is moving to, if one was interrupted"""
+    return get_key_provider().pending_key()
+
+def wrap_key(key):
+    """Encrypt a data key under the master key"""
+    return get_fernet().encrypt(key).decode()
+
+def unwrap_key(wrapped):
+    """Decrypt a wrapped data key
+
+    During a master key rotation some keys may already be wrapped under the
+    pending key, so that one is tried as well.
+    """
+    from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+
+    pending = read_pending_key()
+    if pending is not None:
+        return MultiFernet([get_fernet(), Fernet(pending)]).decrypt(wrapped.encode())
+    try:
+        return get_fernet().decrypt(wrapped.encode())
+    except InvalidToken:
+        # Another process may have finished a rotation since we read KEY_FILE
+        reset_master_key()
+        return get_fernet().decrypt(wrapped.encode())
+
+def derive_key(purpose):
+    """A 32-byte key for a secondary purpose, such as the search index"""
+    return hmac.new(get_master_key(), purpose, hashlib.sha256).digest()
+
+# Stored ciphertext formats. Format 1: a format byte, the data key version,
+# a random nonce, then AES-256-GCM ciphertext and tag over raw bytes.
+# Format 2 is the same with a codec byte after the key version, for
+# plaintext compressed before encryption. Header fields are authenticated
+# too. Fernet tokens (str, or base64 bytes starting with "g") are still
+# read, so older rows need no migration to stay readable.
+FORMAT_AESGCM = 1
+FORMAT_COMPRESSED = 2
+_HEADERS = {FORMAT_AESGCM: struct.Struct(">BI"), FORMAT_COMPRESSED: struct.Struct(">BIB")}
+NONCE_BYTES = 12
+
+# Plaintext shorter than this is stored as is (format 1); longer plaintext
+# is compressed with zlib, or lzma past LZMA_MIN_BYTES, and kept that way
+# only if that makes it smaller
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+COMPRESS_MIN_BYTES = 1024
+LZMA_MIN_BYTES = 64 * 1024
+
+def _compress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 6)
+    import lzma
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=6)
+
+def _decompress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        import lzma
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+    raise ValueError("unknown codec {}".format(codec))
+
+def choose_codec(size):
+    """Codec for a plaintext of size bytes, or None to store it uncompressed"""
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    return CODEC_LZMA if size >= LZMA_MIN_BYTES else CODEC_ZLIB
+
+class DataCipher:
+    """Encrypts with the newest of a set of versioned Fernet keys, decrypts under any of them"""
+
+    def __init__(self, keys):
+        """keys: (version, Fernet key) pairs, newest first"""
+        from cryptography.fernet import Fernet, MultiFernet
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self.current_version = keys[0][0]
+        # The Fernet key is only a seed here: AES-GCM gets its own 256-bit key from it
+        self._aead = {
+            version: AESGCM(hmac.new(base64.urlsafe_b64decode(key), b"lifevault-aes-gcm-v1", hashlib.sha256).digest())
+            for version, key in keys
+        }
+        self._fernet = MultiFernet([Fernet(key) for _, key in keys])
+
+    def _seal(self, header, data):
+        nonce = os.urandom(NONCE_BYTES)
+        return header + nonce + self._aead[self.current_version].encrypt(nonce, data, header)
+
+    def encrypt(self, data, compress=True):
+        """compress=False for data known not to compress, such as most attachments"""
+        codec = choose_codec(len(data)) if compress else None
+        if codec is not None:
+            packed = _compress(codec, data)
+            if len(packed) < len(data):
+                return self._seal(_HEADERS[FORMAT_COMPRESSED].pack(FORMAT_COMPRESSED, self.current_version, codec), packed)
+        return self._seal(_HEADERS[FORMAT_AESGCM].pack(FORMAT_AESGCM, self.current_version), data)
+
+    def decrypt(self, token):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.fernet import InvalidToken
+
+        if isinstance(token, str):
+            return self._fernet.decrypt(token.encode())
+        if token[:1] == bytes((FORMAT_STREAM,)):
+            return b"".join(decrypt_stream(self, [token]))
+        header_format = _HEADERS.get(token[0]) if token else None
+        if header_format is None:
+            return self._fernet.decrypt(token)
+        header = token[:header_format.size]
+        fields = header_format.unpack(header) if len(header) == header_format.size else None
+        aead = self._aead.get(fields[1]) if fields else None
+        if aead is None:
+            raise InvalidToken
+        nonce = token[header_format.size:header_format.size + NONCE_BYTES]
+        try:
+            data = aead.decrypt(nonce, token[header_format.size + NONCE_BYTES:], header)
+        except (InvalidTag, ValueError):
+            # ValueError: too short to hold a nonce; either way, callers see one error type
+            raise InvalidToken from None
+        return _decompress(fields[2], data) if fields[0] == FORMAT_COMPRESSED else data
+
+    def is_current(self, token):
+        """True if token is in one of the binary formats under the newest key"""
+        if not isinstance(token, bytes) or not token or token[0] not in _HEADERS:
+            return False
+        header = token[:_HEADERS[token[0]].size]
+        return len(header) == _HEADERS[token[0]].size and _HEADERS[token[0]].unpack(header)[1] == self.current_version
+
+    def rotate(self, token):
+        """token re-encrypted in the current format under the newest key"""
+        return self.encrypt(self.decrypt(token))
+
+    def encrypt_text(self, text):
+        return self.encrypt(text.encode())
+
+    def decrypt_text(self, token):
+        return self.decrypt(token).decode()
+
+    def encryptor(self, segment_size=None):
+        return StreamEncryptor(self._aead[self.current_version], self.current_version, segment_size or SEGMENT_SIZE)
+
+    def decryptor(self):
+        return StreamDecryptor(self._aead)
 
-fernet = load_key()
+# Stream format 3, for payloads too large to hold in memory: a header
+# (format byte, data key version, segment size, random nonce prefix), then
+# the payload in segments of segment_size bytes, each sealed with AES-GCM
+# on its own. A segment's nonce is the prefix, its index and a flag set only
+# on the last segment, so segments can't be reordered, dropped or cut off
+# at the end without failing authentication. The header is the associated
+# data of every segment. Memory use is about one segment, whatever the size.
+FORMAT_STREAM = 3
+SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+TAG_BYTES = 16
+_STREAM_HEADER = struct.Struct(">BII7s")
+_SEGMENT_COUNTER = struct.Struct(">IB")
 
-def encrypt_data(data):
-    return fernet.encrypt(data.encode()).decode()
+def _segment_nonce(prefix, index, last):
+    if index > 0xFFFFFFFF:
+        raise ValueError("stream has too many segments")
+    return prefix + _SEGMENT_COUNTER.pack(index, 1 if last else 0)
+
+class StreamEncryptor:
+    """Incremental encryption: output = update(data) + ... + finalize()"""
+
+    def __init__(self, aead, key_version, segment_size=SEGMENT_SIZE):
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ValueError("segment size must be between 1 and {}".format(MAX_SEGMENT_SIZE))
+        self._aead = aead
+        self._segment_size = segment_size
+        self._prefix = os.urandom(7)
+        self._header = _STREAM_HEADER.pack(FORMAT_STREAM, key_version, segment_size, self._prefix)
+        self._buffer = bytearray()
+        self._index = 0
+        self._started = False
+
+    def _seal(self, segment, last):
+        sealed = self._aead.encrypt(_segment_nonce(self._prefix, self._index, last), bytes(segment), self._header)
+        self._index += 1
+        return sealed
+
+    def update(self, data):
+        out = [] if self._started else [self._header]
+        self._started = True
+        self._buffer += data
+        # Keep back at least one byte: the last segment can't be sealed until finalize
+        while len(self._buffer) > self._segment_size:
+            out.append(self._seal(self._buffer[:self._segment_size], False))
+            del self._buffer[:self._segment_size]
+        return b"".join(out)
+
+    def finalize(self):
+        out = self.update(b"") + self._seal(self._buffer, True)
+        self._buffer = bytearray()
+        return out
+
+class StreamDecryptor:
+    """Incremental decryption of format 3; finalize() raises InvalidToken if the stream was cut short"""
+
+    def __init__(self, aeads):
+        self._aeads = aeads
+        self._buffer = bytearray()
+        self._header = None
+        self._index = 0
+
+    def _open(self, segment, last):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.fernet import InvalidToken
+
+        try:
+            data = self._aead.decrypt(_segment_nonce(self._prefix, self._index, last), bytes(segment), self._header)
+        except (InvalidTag, ValueError):
+            raise InvalidToken from None
+        self._index += 1
+        return data
+
+    def _read_header(self):
+        from cryptography.fernet import InvalidToken
+
+        header = bytes(self._buffer[:_STREAM_HEADER.size])
+        format_version, key_version, segment_size, self._prefix = _STREAM_HEADER.unpack(header)
+        self._aead = self._aeads.get(key_version)
+        if format_version != FORMAT_STREAM or self._aead is None or not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise InvalidToken
+        self._sealed_size = segment_size + TAG_BYTES
+        self._header = header
+        del self._buffer[:_STREAM_HEADER.size]
+
+    def update(self, data):
+        self._buffer += data
+        if self._header is None:
+            if len(self._buffer) < _STREAM_HEADER.size:
+                return b""
+            self._read_header()
+        out = []
+        # A full segment is only known not to be the last once more data follows it
+        while len(self._buffer) > self._sealed_size:
+            out.append(self._open(self._buffer[:self._sealed_size], False))
+            del self._buffer[:self._sealed_size]
+        return b"".join(out)
+
+    def finalize(self):
+        from cryptography.fernet import InvalidToken
+
+        if self._header is None or len(self._buffer) < TAG_BYTES:
+            raise InvalidToken
+        out = self._open(self._buffer, True)
+        self._buffer = bytearray()
+        return out
+
+def encrypt_stream(cipher, chunks, segment_size=None):
+    """Yield the stream-format ciphertext of an iterable of byte strings, piece by piece"""
+    encryptor = cipher.encryptor(segment_size)
+    for chunk in chunks:
+        out = encryptor.update(chunk)
+        if out:
+            yield out
+    yield encryptor.finalize()
+
+def decrypt_stream(cipher, chunks):
+    """Yield the plaintext of stream-format ciphertext, authenticated a segment at a time
+
+    Everything yielded before an InvalidToken came from segments that did
+    authenticate, but the stream as a whole is only good once this finishes.
+    """
+    decryptor = cipher.decryptor()
+    for chunk in chunks:
+        out = decryptor.update(chunk)
+        if out:
+            yield out
+    yield decryptor.finalize()
+
+def iter_file(f, size=SEGMENT_SIZE):
+    """A binary file's contents, size bytes at a time"""
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+def encrypt_file(cipher, src, dst, segment_size=None):
+    """Encrypt binary file object src into dst; returns the bytes written"""
+    written = 0
+    for piece in encrypt_stream(cipher, iter_file(src), segment_size):
+        written += dst.write(piece)
+    return written
+
+def decrypt_file(cipher, src, dst):
+    """Decrypt binary file object src into dst; returns the bytes written"""
+    written = 0
+    for piece in decrypt_stream(cipher, iter_file(src)):
+        written += dst.write(piece)
+    return written
+
+class EncryptingWriter(io.RawIOBase):
+    """Write-only file object that encrypts into a binary file; close() seals the last segment"""
+
+    def __init__(self, cipher, raw, segment_size=None):
+        self._raw = raw
+        self._encryptor = cipher.encryptor(segment_size)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._raw.write(self._encryptor.update(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._raw.write(self._encryptor.finalize())
+            finally:
+                self._raw.close()
+        super().close()
+
+class DecryptingReader(io.RawIOBase):
+    """Read-only file object over a stream-format file"""
+
+    def __init__(self, cipher, raw):
+        self._raw = raw
+        self._decryptor = cipher.decryptor()
+        self._pending = b""
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and not self._done:
+            chunk = self._raw.read(SEGMENT_SIZE)
+            if chunk:
+                self._pending = self._decryptor.update(chunk)
+            else:
+                self._pending = self._decryptor.finalize()
+                self._done = True
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+def open_encrypted(path, mode="r", cipher=None, encoding="utf-8", newline=None):
+    """Open a stream-format file as a text ("r"/"w") or binary ("rb"/"wb") file object
+
+    The cipher defaults to one over the master key, for files such as
+    backups and exports that don't belong to a single user.
+    """
+    cipher = cipher or master_cipher()
+    if mode.startswith("w"):
+        raw = io.BufferedWriter(EncryptingWriter(cipher, open(path, "wb")), SEGMENT_SIZE)
+    else:
+        raw = io.BufferedReader(DecryptingReader(cipher, open(path, "rb")), SEGMENT_SIZE)
+    if mode.endswith("b"):
+        return raw
+    return io.TextIOWrapper(raw, encoding=encoding, newline=newline)
 
-def decrypt_data(data):
-    return fernet.decrypt(data.encode()).decode()
\ No newline at end of file
+def master_cipher():
+    """A DataCipher under the master key itself (key version 0)"""
+    return DataCipher([(0, get_master_key())])
@@ -0,0 +1,118 @@
+"""Ranked, typo-tolerant search over one user's entries
+
+SessionSearchIndex keeps an inverted index from word trigrams to entry ids,
+built from titles and decrypted content once per login and updated as
+entries are added, edited and deleted. A query is split into trigrams the
+same way; an entry's score is the share of the query's trigrams found in
+its title (or, weighted down a little, its content). "pasport" still finds
+"passport" because most of its trigrams match.
+
+A fragment from the middle of a word ("fish" in "shellfish", "456" in an
+account number) shares few padded word trigrams with it, so each field's
+plain character trigrams are kept as well. An entry holding every
+character trigram of the query in one field contains the query, near
+enough, and scores 1.0. Queries shorter than a trigram match any trigram
+they are part of.
+
+The index holds trigrams, not plaintext, and lives only as long as the
+VaultManager session that built it.
+"""
+import math
+import re
+
+WORD = re.compile(r"\w+")
+NGRAM = 3
+MIN_SCORE = 0.5
+CONTENT_WEIGHT = 0.8
+
+def trigrams(text):
+    """Trigrams of each word, padded so short words and word starts count too"""
+    grams = set()
+    for word in WORD.findall(text.lower()):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+def substrings(text):
+    """Character trigrams of the whole text, spaces included; short text is kept whole"""
+    text = text.lower()
+    if len(text) < NGRAM:
+        return frozenset((text,) if text else ())
+    return frozenset(text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1))
+
+class SessionSearchIndex:
+    def __init__(self):
+        self._postings = {}            # word trigram -> set of entry ids
+        self._substring_postings = {}  # character trigram -> set of entry ids
+        # entry id -> (title trigrams, content trigrams, title substrings, content substrings)
+        self._fields = {}
+
+    def __len__(self):
+        return len(self._fields)
+
+    def add(self, entry_id, title, content):
+        """Index an entry, replacing whatever was indexed for it before"""
+        self.remove(entry_id)
+        fields = (trigrams(title), trigrams(content), substrings(title), substrings(content))
+        self._fields[entry_id] = fields
+        for gram in fields[0] | fields[1]:
+            self._postings.setdefault(gram, set()).add(entry_id)
+        for gram in fields[2] | fields[3]:
+            self._substring_postings.setdefault(gram, set()).add(entry_id)
+
+    def remove(self, entry_id):
+        fields = self._fields.pop(entry_id, None)
+        if fields is None:
+            return
+        for postings, grams in ((self._postings, fields[0] | fields[1]),
+                                (self._substring_postings, fields[2] | fields[3])):
+            for gram in grams:
+                ids = postings[gram]
+                ids.discard(entry_id)
+                if not ids:
+                    del postings[gram]
+
+    def containing(self, query):
+        """Ids of entries whose title or content contains query"""
+        query = query.lower()
+        if not query:
+            return set()
+        if len(query) < NGRAM:
+            # Each trigram is a piece of one field, so holding one that contains query is enough
+            return set().union(*(ids for gram, ids in self._substring_postings.items() if query in gram))
+        grams = substrings(query)
+        rarest = sorted(grams, key=lambda gram: len(self._substring_postings.get(gram, ())))
+        candidates = set(self._substring_postings.get(rarest[0], ()))
+        for gram in rarest[1:]:
+            if not candidates:
+                break
+            candidates &= self._substring_postings.get(gram, set())
+        # Every trigram must come from the same field
+        return {entry_id for entry_id in candidates
+                if grams <= self._fields[entry_id][2] or grams <= self._fields[entry_id][3]}
+
+    def search(self, query, limit=None, min_score=MIN_SCORE):
+        """[(entry_id, score)] best first; entries containing query score 1.0, the rest min_score and up"""
+        scores = dict.fromkeys(self.containing(query), 1.0)
+        grams = trigrams(query)
+        if not grams:
+            return self._ranked(scores, limit)
+        # A result holds at least `needed` of the query's trigrams in one
+        # field, so it must appear in one of the rarest len - needed + 1 of
+        # them; only those postings are scanned
+        needed = max(1, math.ceil(min_score * len(grams) - 1e-9))
+        rarest = sorted(grams, key=lambda gram: len(self._postings.get(gram, ())))
+        candidates = set().union(*(self._postings.get(gram, ()) for gram in rarest[:len(grams) - needed + 1]))
+
+        for entry_id in candidates - scores.keys():
+            title_grams, content_grams = self._fields[entry_id][:2]
+            score = max(len(grams & title_grams), CONTENT_WEIGHT * len(grams & content_grams)) / len(grams)
+            if score >= min_score:
+                scores[entry_id] = score
+        return self._ranked(scores, limit)
+
+    @staticmethod
+    def _ranked(scores, limit):
+        # Best score first; among equals, the newest entry
+        results = sorted(scores.items(), key=lambda result: (-result[1], -result[0]))
+        return results[:limit] if limit else results
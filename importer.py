@@ -0,0 +1,161 @@
+"""Bulk, non-interactive import of vault entries
+
+Input is JSONL (one {"category": ..., "title": ..., "content": ...} object
+per line) or CSV with category, title and content columns. The file is
+streamed, so memory stays bounded by the batch size however large it is.
+A file ending in .enc is decrypted under the master key as it is read
+(see encryption.open_encrypted), so an encrypted file is never written
+out in plaintext first.
+
+Usage:
+    python importer.py USERNAME FILE [--format jsonl|csv] [--batch-size N]
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+from database import get_connection, fetch_one, log_security_event
+from encryption import open_encrypted
+from key_store import get_keyring
+from models import CATEGORIES, find_category
+from search_index import index_entries
+
+BATCH_SIZE = 500
+COMMIT_EVERY = 5000
+MAX_REPORTED_ERRORS = 20
+ENCRYPTED_SUFFIX = ".enc"
+
+def detect_format(path):
+    path = path.lower()
+    if path.endswith(ENCRYPTED_SUFFIX):
+        path = path[:-len(ENCRYPTED_SUFFIX)]
+    return "csv" if path.endswith(".csv") else "jsonl"
+
+def _open(path):
+    if path.lower().endswith(ENCRYPTED_SUFFIX):
+        return open_encrypted(path, "r", newline="")
+    return open(path, newline="", encoding="utf-8")
+
+def read_records(path, fmt=None):
+    """Yield (record, error) pairs one line at a time"""
+    fmt = fmt or detect_format(path)
+    with _open(path) as f:
+        if fmt == "csv":
+            for record in csv.DictReader(f):
+                yield record, None
+            return
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line), None
+            except json.JSONDecodeError as e:
+                yield None, "line {}: invalid JSON ({})".format(line_number, e.msg)
+
+def validate_record(record):
+    """Return (category_id, title, content), or raise ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError("expected an object with category, title and content")
+    category_key = find_category(str(record.get("category") or ""))
+    if category_key is None:
+        raise ValueError("unknown category {!r}".format(record.get("category")))
+    title = str(record.get("title") or "").strip()
+    content = str(record.get("content") or "").strip()
+    if not title:
+        raise ValueError("title cannot be empty")
+    if not content:
+        raise ValueError("content cannot be empty")
+    return CATEGORIES[category_key]["id"], title, content
+
+def _insert_batch(conn, user_id, batch):
+    # Encrypt the whole batch before touching the database
+    keyring = get_keyring(user_id)
+    rows = [(user_id, category, title, keyring.encrypt_text(content)) for category, title, content in batch]
+    conn.executemany(
+        "INSERT INTO vault (user_id, category_id, title, encrypted_data) VALUES (?, ?, ?, ?)", rows
+    )
+    # The batch holds the write lock, so its AUTOINCREMENT ids are consecutive
+    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    first_id = last_id - len(rows) + 1
+    index_entries(conn, user_id, [(first_id + n, content) for n, (_, _, content) in enumerate(batch)])
+
+def import_entries(user_id, path, fmt=None, batch_size=BATCH_SIZE, commit_every=COMMIT_EVERY):
+    """Stream entries from a file into a user's vault and report throughput
+
+    Invalid records are skipped and reported; valid ones are encrypted in
+    batches and inserted with executemany, committing every commit_every rows.
+    """
+    conn = get_connection()
+    # Load (or create) the user's keys before the import's transaction opens
+    get_keyring(user_id)
+    started = time.perf_counter()
+    imported = skipped = uncommitted = 0
+    errors = []
+    batch = []
+
+    def reject(message):
+        nonlocal skipped
+        skipped += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append(message)
+
+    try:
+        for number, (record, error) in enumerate(read_records(path, fmt), 1):
+            if error:
+                reject(error)
+                continue
+            try:
+                batch.append(validate_record(record))
+            except ValueError as e:
+                reject("record {}: {}".format(number, e))
+                continue
+            if len(batch) >= batch_size:
+                _insert_batch(conn, user_id, batch)
+                imported += len(batch)
+                uncommitted += len(batch)
+                batch = []
+                if uncommitted >= commit_every:
+                    conn.commit()
+                    uncommitted = 0
+        if batch:
+            _insert_batch(conn, user_id, batch)
+            imported += len(batch)
+        conn.commit()
+    except Exception:
+        # Keep what was already committed; drop the half-finished transaction
+        conn.rollback()
+        raise
+
+    elapsed = time.perf_counter() - started
+    log_security_event(user_id, "entries_imported",
+                       details="Imported {} entries from {}".format(imported, os.path.basename(path)))
+    return {
+        "imported": imported,
+        "skipped": skipped,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "entries_per_second": round(imported / elapsed, 1) if elapsed else None,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import vault entries from a JSONL or CSV file")
+    parser.add_argument("username")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=("jsonl", "csv"))
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    user = fetch_one("SELECT id FROM users WHERE username = ?", (args.username,))
+    if not user:
+        parser.error("unknown user {!r}".format(args.username))
+    report = import_entries(user[0], args.path, args.format, args.batch_size)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    from database import close_db
+    try:
+        main()
+    finally:
+        close_db()
@@ -0,0 +1,139 @@
+"""Local key agent: keeps the master key in memory for other LifeVault processes
+
+The agent listens on a Unix socket next to the key file it serves
+(secret.key -> secret.key.sock), readable only by the user who started it.
+Processes find it there through key_provider.default_provider() and ask
+for the key instead of reading the file. The agent checks the file's
+inode, size and modification time on every request and re-reads it when
+they change, so a master key rotation is picked up without a restart. It
+exits after --idle-timeout seconds without a request.
+
+Requests and replies are single lines:
+    MASTER /abs/path/secret.key   ->  KEY <key> | MISS
+    PENDING /abs/path/secret.key  ->  KEY <key> | NONE | MISS
+    STATUS                        ->  OK <requests served> <key file>
+    STOP                          ->  OK
+
+Usage:
+    python key_agent.py start [--key-file PATH] [--idle-timeout SECONDS]
+    python key_agent.py status [--key-file PATH]
+    python key_agent.py stop [--key-file PATH]
+"""
+import argparse
+import os
+import socket
+import socketserver
+
+from encryption import KEY_FILE
+from key_provider import PENDING_SUFFIX, AGENT_TIMEOUT, agent_socket_path, read_key_file
+
+IDLE_TIMEOUT = 15 * 60
+
+class KeyAgent:
+    def __init__(self, key_file, idle_timeout=IDLE_TIMEOUT):
+        self.key_file = os.path.abspath(key_file)
+        self.socket_path = agent_socket_path(self.key_file)
+        self.idle_timeout = idle_timeout
+        self.requests = 0
+        self.stopped = False
+        self._cache = {}  # path -> (stat signature, key)
+
+    def _read(self, path, create=False):
+        """A key file's contents, re-read only when the file changes"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if not create:
+                self._cache.pop(path, None)
+                return None
+            read_key_file(path, create=True)
+            st = os.stat(path)
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._cache.get(path)
+        if cached is None or cached[0] != signature:
+            cached = self._cache[path] = (signature, read_key_file(path, create=False))
+        return cached[1]
+
+    def handle(self, line):
+        self.requests += 1
+        command, _, path = line.strip().partition(" ")
+        if command == "STATUS":
+            return "OK {} {}".format(self.requests, self.key_file)
+        if command == "STOP":
+            self.stopped = True
+            return "OK"
+        if command not in ("MASTER", "PENDING") or path != self.key_file:
+            return "MISS"
+        if command == "MASTER":
+            key = self._read(self.key_file, create=True)
+        else:
+            key = self._read(self.key_file + PENDING_SUFFIX)
+        return "KEY {}".format(key.decode()) if key else "NONE"
+
+    def serve(self):
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline().decode(errors="replace")
+                self.wfile.write((agent.handle(line) + "\n").encode())
+
+        class Server(socketserver.UnixStreamServer):
+            def handle_timeout(self):
+                agent.stopped = True
+
+        self._read(self.key_file, create=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left behind by an agent that didn't exit cleanly
+        old_umask = os.umask(0o177)
+        try:
+            server = Server(self.socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        server.timeout = self.idle_timeout
+        try:
+            while not self.stopped:
+                server.handle_request()
+        finally:
+            server.server_close()
+            try:
+                os.remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+def send_command(key_file, command):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(AGENT_TIMEOUT)
+        conn.connect(agent_socket_path(os.path.abspath(key_file)))
+        conn.sendall((command + "\n").encode())
+        return conn.makefile("rb").readline().decode().strip()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hold the master key in memory for other LifeVault processes")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    start = subcommands.add_parser("start", help="run the agent in the foreground")
+    start.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT)
+    status = subcommands.add_parser("status", help="check whether an agent is running")
+    stop = subcommands.add_parser("stop", help="stop a running agent")
+    for sub in (start, status, stop):
+        sub.add_argument("--key-file", default=KEY_FILE)
+    args = parser.parse_args(argv)
+
+    if not hasattr(socket, "AF_UNIX"):
+        parser.error("the key agent needs Unix domain sockets")
+    if args.command == "start":
+        agent = KeyAgent(args.key_file, args.idle_timeout)
+        print("Serving {} on {}".format(agent.key_file, agent.socket_path), flush=True)
+        try:
+            agent.serve()
+        except KeyboardInterrupt:
+            pass
+        print("Agent stopped after {} requests".format(agent.requests))
+        return
+    try:
+        print(send_command(args.key_file, args.command.upper()))
+    except OSError:
+        print("No agent running for {}".format(args.key_file))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Where the master key comes from
+
+encryption.py asks a KeyProvider for the master key the first time it is
+needed and the provider keeps it until forget() is called. Each provider
+times its real fetches (not the memoized ones) in `stats`.
+
+FileKeyProvider reads the key file, creating it on first run.
+AgentKeyProvider asks a key agent (key_agent.py) over a local socket and
+falls back to the file if no agent answers. The agent keeps the key in
+memory, so a run of short-lived commands reads the key file once rather
+than once per process; it stands in for an OS keystore or remote key
+service, which would plug in the same way.
+
+default_provider() picks the agent when its socket sits next to the key
+file (KEY_FILE + AGENT_SUFFIX), otherwise the file.
+"""
+import os
+import socket
+import threading
+import time
+
+# A new master key waits here while the per-user keys are rewrapped under it
+PENDING_SUFFIX = ".next"
+AGENT_SUFFIX = ".sock"
+AGENT_TIMEOUT = 0.5  # seconds to wait for the agent before using the file
+
+class FetchStats:
+    """Latency of a provider's uncached key fetches"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last_source = None
+
+    def record(self, seconds, source):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last_source = source
+
+    def as_dict(self):
+        return {
+            "fetches": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else None,
+            "max_ms": round(self.max * 1000, 3),
+            "last_source": self.last_source,
+        }
+
+class KeyProvider:
+    """Memoizes the master key and times each real fetch; subclasses implement _fetch_master"""
+
+    key_file = None
+
+    def __init__(self):
+        self._key = None
+        self._lock = threading.Lock()
+        self.stats = FetchStats()
+
+    def master_key(self):
+        if self._key is None:
+            with self._lock:
+                if self._key is None:
+                    started = time.perf_counter()
+                    key, source = self._fetch_master()
+                    self.stats.record(time.perf_counter() - started, source)
+                    self._key = key
+        return self._key
+
+    def pending_key(self):
+        """The key a master key rotation is moving to, or None"""
+        return None
+
+    def forget(self):
+        with self._lock:
+            self._key = None
+
+    def _fetch_master(self):
+        """(key, source name)"""
+        raise NotImplementedError
+
+class FileKeyProvider(KeyProvider):
+    def __init__(self, path, create=True):
+        super().__init__()
+        self.key_file = path
+        self.create = create
+
+    def _fetch_master(self):
+        return read_key_file(self.key_file, self.create), "file"
+
+    def pending_key(self):
+        return read_key_file(self.key_file + PENDING_SUFFIX, create=False)
+
+class AgentKeyProvider(KeyProvider):
+    def __init__(self, socket_path, fallback):
+        super().__init__()
+        self.socket_path = socket_path
+        self.fallback = fallback
+        self.key_file = fallback.key_file
+
+    def _ask(self, command):
+        """The agent's key for command, None if it has none, or OSError if it can't be reached"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(AGENT_TIMEOUT)
+            conn.connect(self.socket_path)
+            conn.sendall("{} {}\n".format(command, os.path.abspath(self.key_file)).encode())
+            reply = conn.makefile("rb").readline().split()
+        if reply[:1] == [b"KEY"] and len(reply) == 2:
+            return reply[1]
+        if reply == [b"NONE"]:
+            return None
+        raise ConnectionError("agent does not serve {}".format(self.key_file))
+
+    def _fetch_master(self):
+        try:
+            key = self._ask("MASTER")
+            if key is not None:
+                return key, "agent"
+        except OSError:
+            pass
+        return self.fallback._fetch_master()
+
+    def pending_key(self):
+        try:
+            return self._ask("PENDING")
+        except OSError:
+            return self.fallback.pending_key()
+
+def read_key_file(path, create=True):
+    """A key file's contents; a new key is written first if create is set and it doesn't exist"""
+    if not os.path.exists(path):
+        if not create:
+            return None
+        # Imported here so that importing this module stays cheap
+        from cryptography.fernet import Fernet
+        key = Fernet.generate_key()
+        with open(path, "wb") as f:
+            f.write(key)
+        return key
+    with open(path, "rb") as f:
+        return f.read()
+
+def agent_socket_path(key_file):
+    return key_file + AGENT_SUFFIX
+
+def default_provider(key_file):
+    """The agent's provider if one is listening next to key_file, else the file's"""
+    provider = FileKeyProvider(key_file)
+    socket_path = agent_socket_path(key_file)
+    if hasattr(socket, "AF_UNIX") and os.path.exists(socket_path):
+        return AgentKeyProvider(socket_path, provider)
+    return provider
@@ -0,0 +1,227 @@
+"""Key rotation: rewrapping per-user keys and re-encrypting data in the background
+
+Rotating the master key only rewraps the rows of user_keys, in one short
+transaction. The new key is first written to secret.key.next and only
+replaces secret.key once every row is rewrapped; until then unwrap_key
+accepts either, so an interrupted rotation is finished by running it again.
+
+Rotating a user's data key gives them a new current version at once (new
+writes use it) and queues a job in key_rotations. A background thread then
+re-encrypts the user's entries BATCH_SIZE rows at a time, each batch
+committed together with the job's checkpoint, followed by their attachment
+chunks one attachment at a time. Reads keep working throughout, since the
+keyring still holds the old versions. A job picks up from its checkpoint
+after a restart, and when it finishes the old versions are deleted.
+
+Usage:
+    python key_rotation.py status
+    python key_rotation.py run
+    python key_rotation.py rotate-data USERNAME
+    python key_rotation.py rotate-master
+"""
+import argparse
+import json
+import os
+import threading
+
+from database import transaction, fetch_one, fetch_all, get_connection, log_security_event
+from encryption import get_key_provider, read_pending_key, unwrap_key, reset_master_key
+from key_provider import PENDING_SUFFIX
+from key_store import get_keyring, forget, add_data_key, retire_data_keys
+from attachments import reencrypt_attachment
+
+BATCH_SIZE = 200
+BATCH_PAUSE = 0.05  # seconds between batches, so foreground writers get the lock
+
+def start_rotation(user_id, background=True):
+    """Switch a user to a new data key and queue re-encryption of their data; returns the job id"""
+    version = add_data_key(user_id)
+    with transaction() as conn:
+        # The new job covers everything an unfinished older one would
+        conn.execute(
+            "UPDATE key_rotations SET stage = 'superseded', finished_at = CURRENT_TIMESTAMP WHERE user_id = ? AND finished_at IS NULL",
+            (user_id,)
+        )
+        job_id = conn.execute(
+            "INSERT INTO key_rotations (user_id, target_version) VALUES (?, ?)", (user_id, version)
+        ).lastrowid
+    log_security_event(user_id, "data_key_rotated", details=f"Version: {version}")
+    if background:
+        _worker.start()
+    return job_id
+
+def next_job():
+    """(id, user_id, target_version, stage, last_id) of the oldest unfinished job, or None"""
+    return fetch_one(
+        "SELECT id, user_id, target_version, stage, last_id FROM key_rotations WHERE finished_at IS NULL ORDER BY id LIMIT 1"
+    )
+
+def _rotate_entries(job_id, user_id, last_id):
+    keyring = get_keyring(user_id)
+    rows = fetch_all(
+        "SELECT id, encrypted_data FROM vault WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+        (user_id, last_id, BATCH_SIZE)
+    )
+    with transaction() as conn:
+        if not rows:
+            conn.execute("UPDATE key_rotations SET stage = 'attachments', last_id = 0 WHERE id = ?", (job_id,))
+            return
+        # An entry edited since it was read keeps its new ciphertext, already under the new key
+        conn.executemany(
+            "UPDATE vault SET encrypted_data = ? WHERE id = ? AND encrypted_data = ?",
+            [(keyring.rotate(encrypted), entry_id, encrypted)
+             for entry_id, encrypted in rows if not keyring.is_current(encrypted)]
+        )
+        conn.execute(
+            "UPDATE key_rotations SET last_id = ?, rows_done = rows_done + ? WHERE id = ?",
+            (rows[-1][0], len(rows), job_id)
+        )
+
+def _rotate_attachment(job_id, user_id, last_id):
+    row = fetch_one(
+        "SELECT id FROM attachments WHERE user_id = ? AND id > ? ORDER BY id LIMIT 1", (user_id, last_id)
+    )
+    if row is None:
+        _finish(job_id, user_id)
+        return
+    chunks = reencrypt_attachment(user_id, row[0])
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE key_rotations SET last_id = ?, rows_done = rows_done + ? WHERE id = ?", (row[0], chunks, job_id)
+        )
+
+def _finish(job_id, user_id):
+    target_version = fetch_one("SELECT target_version FROM key_rotations WHERE id = ?", (job_id,))[0]
+    retire_data_keys(user_id, target_version)
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE key_rotations SET stage = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,)
+        )
+    log_security_event(user_id, "key_rotation_finished", details=f"Version: {target_version}")
+
+def run_step():
+    """Do one batch of the oldest unfinished job; False once there is nothing left to do"""
+    job = next_job()
+    if job is None:
+        return False
+    job_id, user_id, _, stage, last_id = job
+    if stage == "entries":
+        _rotate_entries(job_id, user_id, last_id)
+    else:
+        _rotate_attachment(job_id, user_id, last_id)
+    return True
+
+class RotationWorker:
+    """Runs queued re-encryption jobs on a daemon thread until they're done or it's stopped"""
+
+    def __init__(self, pause=BATCH_PAUSE):
+        self.pause = pause
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name="key-rotation", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set() and run_step():
+                self._stopped.wait(self.pause)
+        except Exception as e:
+            # The job keeps its checkpoint and is retried on the next start
+            log_security_event(None, "key_rotation_failed", details=str(e))
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+_worker = RotationWorker()
+
+def resume_key_rotations():
+    """Carry on with any unfinished jobs in the background"""
+    if next_job() is not None:
+        _worker.start()
+
+def stop_key_rotation():
+    """Stop the background job after its current batch; called before close_db"""
+    _worker.stop()
+
+def rotate_master_key():
+    """Rewrap every user key under a new master key and make it the one in the key file"""
+    from cryptography.fernet import Fernet
+
+    if fetch_one("SELECT 1 FROM user_keys WHERE wrapped_key IS NULL LIMIT 1"):
+        raise RuntimeError("some data is still encrypted directly under the master key; let the key rotation jobs finish first")
+
+    key_file = get_key_provider().key_file
+    pending_path = key_file + PENDING_SUFFIX
+    pending = read_pending_key()
+    if pending is None:
+        pending = Fernet.generate_key()
+        with open(pending_path + ".partial", "wb") as f:
+            f.write(pending)
+        os.replace(pending_path + ".partial", pending_path)
+    new_master = Fernet(pending)
+
+    conn = get_connection()
+    with conn:
+        # Taken before reading, so no key can be added under the old master meanwhile
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("SELECT user_id, purpose, version, wrapped_key FROM user_keys").fetchall()
+        conn.executemany(
+            "UPDATE user_keys SET wrapped_key = ? WHERE user_id = ? AND purpose = ? AND version = ?",
+            [(new_master.encrypt(unwrap_key(wrapped)).decode(), user_id, purpose, version)
+             for user_id, purpose, version, wrapped in rows]
+        )
+    os.replace(pending_path, key_file)
+    reset_master_key()
+    forget()
+    log_security_event(None, "master_key_rotated", details=f"Keys rewrapped: {len(rows)}", sync=True)
+    return len(rows)
+
+def rotation_status():
+    rows = fetch_all(
+        """SELECT k.id, u.username, k.target_version, k.stage, k.last_id, k.rows_done, k.started_at, k.finished_at
+           FROM key_rotations k LEFT JOIN users u ON u.id = k.user_id ORDER BY k.id"""
+    )
+    columns = ("id", "username", "target_version", "stage", "last_id", "rows_done", "started_at", "finished_at")
+    return [dict(zip(columns, row)) for row in rows]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rotate master and per-user encryption keys")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("status", help="list key rotation jobs")
+    subcommands.add_parser("run", help="finish all queued jobs in the foreground")
+    rotate_data = subcommands.add_parser("rotate-data", help="give a user a new data key and re-encrypt their data")
+    rotate_data.add_argument("username")
+    subcommands.add_parser("rotate-master", help="rewrap all user keys under a new master key")
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        print(json.dumps(rotation_status(), indent=2))
+    elif args.command == "rotate-master":
+        print("Rewrapped {} keys".format(rotate_master_key()))
+    else:
+        if args.command == "rotate-data":
+            user = fetch_one("SELECT id FROM users WHERE username = ?", (args.username,))
+            if not user:
+                parser.error("unknown user {!r}".format(args.username))
+            print("Queued job {}".format(start_rotation(user[0], background=False)))
+        steps = 0
+        while run_step():
+            steps += 1
+        print("Ran {} batches; no jobs left".format(steps))
+
+if __name__ == "__main__":
+    from database import close_db
+    try:
+        main()
+    finally:
+        stop_key_rotation()
+        close_db()
@@ -0,0 +1,180 @@
+"""Per-user keys under the master key (envelope encryption)
+
+Each user has data keys that encrypt their vault content and attachments
+(see encryption.DataCipher), and an index key from which the search-token and blob-address
+keys are derived. All are stored in user_keys wrapped by the master key in
+secret.key. Rotating the master key therefore only rewraps these few rows
+(see key_rotation.py).
+
+A user can hold several data key versions at once: new data is always
+encrypted under the newest, and anything older still decrypts until a
+re-encryption job has moved it over and retired the old versions. Version
+0 stands for the master key itself, which encrypted everything before
+per-user keys existed.
+
+Unwrapped keys are cached per user for the life of the process or until
+forget() is called (on logout).
+"""
+import hashlib
+import hmac
+import os
+import threading
+
+from database import get_connection, transaction, fetch_all
+from encryption import DataCipher, get_master_key, wrap_key, unwrap_key
+
+DATA = "data"
+INDEX = "index"
+LEGACY_VERSION = 0
+
+_keyrings = {}
+_lock = threading.Lock()
+
+class UserKeyring:
+    """A user's unwrapped keys"""
+
+    def __init__(self, user_id, data_keys, index_key):
+        self.user_id = user_id
+        self.versions = sorted(data_keys, reverse=True)
+        self.current_version = self.versions[0]
+        # Newest first: it encrypts, and any of them decrypts
+        self.keys = tuple((version, data_keys[version]) for version in self.versions)
+        self.cipher = DataCipher(self.keys)
+        self._index_key = index_key
+        self._subkeys = {}
+
+    @property
+    def has_legacy_data(self):
+        return LEGACY_VERSION in self.versions
+
+    def encrypt(self, data, compress=True):
+        return self.cipher.encrypt(data, compress)
+
+    def decrypt(self, token):
+        return self.cipher.decrypt(token)
+
+    def encrypt_text(self, text):
+        return self.cipher.encrypt_text(text)
+
+    def decrypt_text(self, token):
+        return self.cipher.decrypt_text(token)
+
+    def is_current(self, token):
+        return self.cipher.is_current(token)
+
+    def rotate(self, token):
+        """Re-encrypt a token in the current format under the current data key"""
+        return self.cipher.rotate(token)
+
+    def subkey(self, purpose):
+        """A 32-byte key for a secondary purpose; stays the same across data key rotations"""
+        if purpose not in self._subkeys:
+            self._subkeys[purpose] = hmac.new(self._index_key, purpose, hashlib.sha256).digest()
+        return self._subkeys[purpose]
+
+def _generate_key():
+    from cryptography.fernet import Fernet
+
+    return Fernet.generate_key()
+
+def _load(user_id):
+    data_keys = {}
+    index_key = None
+    for purpose, version, wrapped in fetch_all(
+        "SELECT purpose, version, wrapped_key FROM user_keys WHERE user_id = ?", (user_id,)
+    ):
+        if purpose == INDEX:
+            index_key = unwrap_key(wrapped)
+        elif version == LEGACY_VERSION:
+            data_keys[version] = get_master_key()
+        else:
+            data_keys[version] = unwrap_key(wrapped)
+    return data_keys, index_key
+
+def _insert_missing(conn, user_id, data_keys, index_key):
+    # OR IGNORE: if another process got there first, its keys win and are re-read
+    if not any(version != LEGACY_VERSION for version in data_keys):
+        conn.execute(
+            "INSERT OR IGNORE INTO user_keys (user_id, purpose, version, wrapped_key) VALUES (?, ?, ?, ?)",
+            (user_id, DATA, max(data_keys, default=LEGACY_VERSION) + 1, wrap_key(_generate_key()))
+        )
+    if index_key is None:
+        conn.execute(
+            "INSERT OR IGNORE INTO user_keys (user_id, purpose, version, wrapped_key) VALUES (?, ?, 1, ?)",
+            (user_id, INDEX, wrap_key(os.urandom(32)))
+        )
+
+def _create_missing(user_id, data_keys, index_key):
+    """Give a user their first data key and index key; True if that joined an open transaction"""
+    conn = get_connection()
+    if conn.in_transaction:
+        # Committing here would commit the caller's half-done work too
+        _insert_missing(conn, user_id, data_keys, index_key)
+        return True
+    with transaction() as conn:
+        _insert_missing(conn, user_id, data_keys, index_key)
+    return False
+
+def get_keyring(user_id):
+    """The user's keyring, creating their keys on first use"""
+    keyring = _keyrings.get(user_id)
+    if keyring is not None:
+        return keyring
+    with _lock:
+        keyring = _keyrings.get(user_id)
+        if keyring is None:
+            data_keys, index_key = _load(user_id)
+            if index_key is None or not any(version != LEGACY_VERSION for version in data_keys):
+                if _create_missing(user_id, data_keys, index_key):
+                    # Not cached until the caller's transaction is known to have committed
+                    return UserKeyring(user_id, *_load(user_id))
+                data_keys, index_key = _load(user_id)
+            keyring = _keyrings[user_id] = UserKeyring(user_id, data_keys, index_key)
+        return keyring
+
+def forget(user_id=None):
+    """Drop cached keys for one user, or for everyone"""
+    with _lock:
+        if user_id is None:
+            _keyrings.clear()
+        else:
+            _keyrings.pop(user_id, None)
+
+def add_data_key(user_id):
+    """Make a new data key version current for a user and return its number"""
+    get_keyring(user_id)
+    with transaction() as conn:
+        version = conn.execute(
+            "SELECT MAX(version) FROM user_keys WHERE user_id = ? AND purpose = ?", (user_id, DATA)
+        ).fetchone()[0] + 1
+        conn.execute(
+            "INSERT INTO user_keys (user_id, purpose, version, wrapped_key) VALUES (?, ?, ?, ?)",
+            (user_id, DATA, version, wrap_key(_generate_key()))
+        )
+    forget(user_id)
+    return version
+
+def retire_data_keys(user_id, below_version):
+    """Delete data key versions nothing is encrypted under any more"""
+    with transaction() as conn:
+        conn.execute(
+            "DELETE FROM user_keys WHERE user_id = ? AND purpose = ? AND version < ?", (user_id, DATA, below_version)
+        )
+    forget(user_id)
+
+def encrypt_for_user(user_id, text):
+    return get_keyring(user_id).encrypt_text(text)
+
+def with_keyring(user_id, func):
+    """func(keyring), retried once with freshly loaded keys if it hits an unknown token"""
+    from cryptography.fernet import InvalidToken
+
+    try:
+        return func(get_keyring(user_id))
+    except InvalidToken:
+        # Another process may have added a key since ours was cached
+        forget(user_id)
+        return func(get_keyring(user_id))
+
+def decrypt_for_user(user_id, token):
+    return with_keyring(user_id, lambda keyring: keyring.decrypt_text(token))
@@ -0,0 +1,171 @@
+"""Time-partitioned storage for security logs
+
+security_logs holds only the last HOT_DAYS of events (the hot partition).
+Older events are moved into one table per month in an archive database
+next to vault.db, and months older than RETENTION_MONTHS are compacted into
+per-day counts in security_log_summary and dropped.
+"""
+import datetime
+import os
+import sqlite3
+
+from database import open_connection, get_database_path, fetch_all, flush_audit_log, TIMESTAMP_FORMAT
+
+HOT_DAYS = 30
+RETENTION_MONTHS = 12
+ARCHIVE_SCHEMA = "logs"
+
+def get_archive_path():
+    """vault.db -> vault_logs.db, in the same directory"""
+    root, ext = os.path.splitext(get_database_path())
+    return "{}_logs{}".format(root, ext or ".db")
+
+def _partition_name(month):
+    """'2024-03' -> 'security_logs_2024_03'"""
+    return "security_logs_" + month.replace("-", "_")
+
+def _month_start(month):
+    return month + "-01 00:00:00"
+
+def _next_month(month):
+    year, mon = int(month[:4]), int(month[5:7])
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return "{:04d}-{:02d}".format(year, mon)
+
+def _months_ago(now, months):
+    index = now.year * 12 + now.month - 1 - months
+    return "{:04d}-{:02d}".format(index // 12, index % 12 + 1)
+
+def _attach_archive(conn):
+    attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+    if ARCHIVE_SCHEMA in attached:
+        return
+    path = get_archive_path()
+    is_new = not os.path.exists(path)
+    conn.execute("ATTACH DATABASE ? AS {}".format(ARCHIVE_SCHEMA), (path,))
+    if is_new:
+        # Only takes effect before the first table is created
+        conn.execute("PRAGMA {}.auto_vacuum = INCREMENTAL".format(ARCHIVE_SCHEMA))
+
+def archive_partitions(conn, schema=ARCHIVE_SCHEMA):
+    """Archived months, newest first"""
+    rows = conn.execute(
+        "SELECT name FROM {}sqlite_master WHERE type = 'table' AND name LIKE 'security_logs_%'".format(
+            schema + "." if schema else "")
+    ).fetchall()
+    return sorted((name for (name,) in rows), reverse=True)
+
+def rotate_security_logs(conn, now, hot_days=HOT_DAYS):
+    """Move events older than the hot window into monthly archive tables"""
+    cutoff = (now - datetime.timedelta(days=hot_days)).strftime(TIMESTAMP_FORMAT)
+    oldest = conn.execute("SELECT MIN(timestamp) FROM security_logs").fetchone()[0]
+    if oldest is None or oldest >= cutoff:
+        return 0
+
+    months = [row[0] for row in conn.execute(
+        "SELECT DISTINCT substr(timestamp, 1, 7) FROM security_logs WHERE timestamp < ?", (cutoff,)
+    )]
+    moved = 0
+    for month in months:
+        table = "{}.{}".format(ARCHIVE_SCHEMA, _partition_name(month))
+        bounds = (_month_start(month), min(_month_start(_next_month(month)), cutoff))
+        with conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS {} (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                action TEXT NOT NULL,
+                ip_address TEXT,
+                timestamp TIMESTAMP,
+                details TEXT
+            )
+            '''.format(table))
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_user_time ON {1} (user_id, timestamp)".format(
+                    table, _partition_name(month))
+            )
+            # OR IGNORE keeps this idempotent: commits across attached WAL
+            # databases are not atomic, so a crash can leave rows in both
+            conn.execute(
+                """INSERT OR IGNORE INTO {} (id, user_id, action, ip_address, timestamp, details)
+                   SELECT id, user_id, action, ip_address, timestamp, details FROM main.security_logs
+                   WHERE timestamp >= ? AND timestamp < ?""".format(table),
+                bounds
+            )
+            moved += conn.execute(
+                "DELETE FROM main.security_logs WHERE timestamp >= ? AND timestamp < ?", bounds
+            ).rowcount
+    return moved
+
+def compact_security_logs(conn, now, retention_months=RETENTION_MONTHS):
+    """Fold archived months past retention into per-day counts and drop them"""
+    oldest_kept = _months_ago(now, retention_months)
+    compacted = []
+    for name in archive_partitions(conn):
+        month = name[len("security_logs_"):].replace("_", "-")
+        if month >= oldest_kept:
+            continue
+        with conn:
+            already_done = conn.execute(
+                "SELECT 1 FROM security_log_summary WHERE day >= ? AND day < ? LIMIT 1",
+                (month + "-01", _next_month(month) + "-01")
+            ).fetchone()
+            if not already_done:
+                conn.execute(
+                    """INSERT INTO security_log_summary (user_id, day, action, event_count)
+                       SELECT user_id, date(timestamp), action, COUNT(*) FROM {}.{}
+                       GROUP BY user_id, date(timestamp), action""".format(ARCHIVE_SCHEMA, name)
+                )
+            conn.execute("DROP TABLE {}.{}".format(ARCHIVE_SCHEMA, name))
+        compacted.append(month)
+    if compacted:
+        conn.execute("PRAGMA {}.incremental_vacuum".format(ARCHIVE_SCHEMA))
+    return compacted
+
+def maintain_security_logs(hot_days=HOT_DAYS, retention_months=RETENTION_MONTHS, now=None):
+    """Rotate and compact the security logs; cheap when there is nothing to do"""
+    now = now or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    flush_audit_log()
+    conn = open_connection()
+    try:
+        cutoff = (now - datetime.timedelta(days=hot_days)).strftime(TIMESTAMP_FORMAT)
+        oldest = conn.execute("SELECT MIN(timestamp) FROM security_logs").fetchone()[0]
+        if (oldest is None or oldest >= cutoff) and not os.path.exists(get_archive_path()):
+            return {"moved": 0, "compacted": []}
+        _attach_archive(conn)
+        moved = rotate_security_logs(conn, now, hot_days)
+        compacted = compact_security_logs(conn, now, retention_months)
+        return {"moved": moved, "compacted": compacted}
+    finally:
+        conn.close()
+
+def recent_security_logs(user_id, limit=20):
+    """Newest events first; archive partitions are read only if the hot one runs short"""
+    flush_audit_log()
+    logs = fetch_all(
+        "SELECT action, timestamp, details FROM security_logs WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
+        (user_id, limit)
+    )
+    if len(logs) >= limit or not os.path.exists(get_archive_path()):
+        return logs
+
+    archive = sqlite3.connect(get_archive_path())
+    try:
+        for name in archive_partitions(archive, schema=None):
+            logs += archive.execute(
+                "SELECT action, timestamp, details FROM {} WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?".format(name),
+                (user_id, limit - len(logs))
+            ).fetchall()
+            if len(logs) >= limit:
+                break
+    finally:
+        archive.close()
+    return logs
+
+def daily_summary(user_id, since_day=None):
+    """Per-day event counts for compacted months"""
+    return fetch_all(
+        """SELECT day, action, event_count FROM security_log_summary
+           WHERE user_id = ? AND day >= ? ORDER BY day, action""",
+        (user_id, since_day or "0000-00-00")
+    )
@@ -1,8 +1,10 @@
 from ascii_ui import print_banner, print_auth_menu, print_main_menu, get_user_choice, print_error, print_success, print_info, refresh_screen
 from auth import AuthManager
-from vault import VaultManager
-from emergency import EmergencyManager
-from database import close_db, log_security_event
+from vault import VaultManager, count_entries
+from emergency import EmergencyManager, count_emergency_contacts
+from database import close_db, execute, log_security_event
+from log_archive import maintain_security_logs, recent_security_logs
+from key_rotation import resume_key_rotations, stop_key_rotation
 import sys
 
 class PersonalDataVault:
@@ -30,7 +32,7 @@ class PersonalDataVault:
                 else:
                     refresh_screen()
             elif choice == 3:
-                self.auth_manager.emergency_access(self.vault_manager)
+                self.auth_manager.emergency_access()
                 refresh_screen()
             elif choice == 4:
                 print_success("Thank you for using Personal Data Vault!")
@@ -59,7 +61,7 @@ class PersonalDataVault:
                 elif choice == 7:
                     self.emergency_manager.manage_emergency_contacts()
                 elif choice == 8:
-                    self.auth_manager.emergency_access(self.vault_manager)
+                    self.auth_manager.emergency_access()
                 elif choice == 9:
                     self.emergency_manager.view_emergency_contacts()
                 elif choice == 10:
@@ -72,6 +74,7 @@ class PersonalDataVault:
                     self.auth_manager.change_password()
                 elif choice == 14:
                     self.auth_manager.logout()
+                    self.vault_manager.unload()
                     break
                     
             except KeyboardInterrupt:
@@ -163,8 +166,8 @@ class PersonalDataVault:
         print(f"Account created: {user.created_at}")
         
         # Get statistics
-        entry_count = len(self.vault_manager.data_entries)
-        contact_count = len(self.emergency_manager.get_user_emergency_contacts(user.id))
+        entry_count = count_entries(user.id)
+        contact_count = count_emergency_contacts(user.id)
         
         print(f"Total entries: {entry_count}")
         print(f"Emergency contacts: {contact_count}")
@@ -188,11 +191,10 @@ class PersonalDataVault:
             return
         
         # Update email
-        self.auth_manager.cursor.execute(
+        execute(
             "UPDATE users SET email = ? WHERE id = ?",
             (new_email, self.auth_manager.current_user.id)
         )
-        self.auth_manager.conn.commit()
         
         # Update current user object
         self.auth_manager.current_user.email = new_email
@@ -224,11 +226,10 @@ class PersonalDataVault:
         
         # Update PIN
         new_pin_hash = self.auth_manager.hash_password(new_pin)
-        self.auth_manager.cursor.execute(
+        execute(
             "UPDATE users SET emergency_pin = ? WHERE id = ?",
             (new_pin_hash, self.auth_manager.current_user.id)
         )
-        self.auth_manager.conn.commit()
         
         # Update current user object
         self.auth_manager.current_user.emergency_pin = new_pin_hash
@@ -241,11 +242,7 @@ class PersonalDataVault:
         print("\n📜 Security Logs")
         print("═" * 20)
         
-        self.auth_manager.cursor.execute(
-            "SELECT action, timestamp, details FROM security_logs WHERE user_id = ? ORDER BY timestamp DESC LIMIT 20",
-            (self.auth_manager.current_user.id,)
-        )
-        logs = self.auth_manager.cursor.fetchall()
+        logs = recent_security_logs(self.auth_manager.current_user.id, limit=20)
         
         if not logs:
             print_info("No security logs found.")
@@ -262,13 +259,21 @@ def main():
     """Main entry point"""
     try:
         app = PersonalDataVault()
+        resume_key_rotations()
         app.run()
     except KeyboardInterrupt:
         print("\n\n👋 Goodbye!")
     except Exception as e:
         print_error(f"Application error: {e}")
     finally:
-        close_db()
+        try:
+            stop_key_rotation()
+            maintain_security_logs()
+        except Exception as e:
+            # Nothing is lost: the logs are simply archived on a later exit
+            print_error(f"Could not archive old security logs: {e}")
+        finally:
+            close_db()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
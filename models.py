@@ -1,4 +1,5 @@
 from datetime import datetime
+from functools import lru_cache
 
 class User:
     def __init__(self, id, username, password_hash, email, emergency_pin, created_at):
@@ -9,30 +10,98 @@ class User:
         self.emergency_pin = emergency_pin
         self.created_at = created_at
 
+class EntryContext:
+    """What every entry of one listing shares: how its content is decrypted, cached and fetched"""
+    __slots__ = ("decrypt_func", "cache", "load_func")
+
+    def __init__(self, decrypt_func, cache=None, load_func=None):
+        self.decrypt_func = decrypt_func
+        self.cache = cache
+        self.load_func = load_func
+
 class VaultData:
-    def __init__(self, id, user_id, category, title, encrypted_data, created_at, updated_at, decrypt_func):
+    # Slots instead of a per-entry __dict__, and one shared EntryContext
+    # instead of three references per entry: a loaded vault can hold a
+    # great many of these
+    __slots__ = ("id", "user_id", "category_id", "title", "_encrypted_data", "created_at", "updated_at", "context")
+
+    def __init__(self, id, user_id, category_id, title, encrypted_data, created_at, updated_at, context):
         self.id = id
         self.user_id = user_id
-        self.category = category
+        self.category_id = category_id
         self.title = title
-        self.encrypted_data = encrypted_data
+        self._encrypted_data = encrypted_data
         self.created_at = created_at
         self.updated_at = updated_at
-        self.decrypt_func = decrypt_func
+        self.context = context
+
+    @property
+    def decrypt_func(self):
+        return self.context.decrypt_func
+
+    @property
+    def cache(self):
+        return self.context.cache
+
+    @property
+    def load_func(self):
+        return self.context.load_func
+
+    @property
+    def category_key(self):
+        return CATEGORY_KEYS.get(self.category_id, "other")
+
+    @property
+    def category(self):
+        """Display name of the entry's category"""
+        return CATEGORIES[self.category_key]["name"]
+
+    @property
+    def encrypted_data(self):
+        """Ciphertext, fetched with load_func the first time it's needed"""
+        if self._encrypted_data is None and self.load_func is not None:
+            self._encrypted_data = self.load_func(self.id)
+        return self._encrypted_data
+
+    @property
+    def ciphertext_loaded(self):
+        return self._encrypted_data is not None
+
+    @encrypted_data.setter
+    def encrypted_data(self, value):
+        self._encrypted_data = value
 
     def get_decrypted_content(self):
-        return self.decrypt_func(self.encrypted_data)
+        """decrypt_func is called as decrypt_func(user_id, ciphertext)"""
+        if self.cache is None:
+            return self.decrypt_func(self.user_id, self.encrypted_data)
+        content = self.cache.get(self.id, self.encrypted_data)
+        if content is None:
+            content = self.decrypt_func(self.user_id, self.encrypted_data)
+            self.cache.put(self.id, self.encrypted_data, content)
+        return content
+
+@lru_cache(maxsize=256)
+def parse_allowed_categories(value):
+    """Split a stored allowed_categories string; contacts with the same grants share the result"""
+    return tuple(c.strip().lower() for c in value.split(","))
 
 class EmergencyContact:
+    __slots__ = ("id", "user_id", "name", "phone", "email", "allowed_categories_raw", "created_at")
+
     def __init__(self, id, user_id, name, phone, email, allowed_categories, created_at):
         self.id = id
         self.user_id = user_id
         self.name = name
         self.phone = phone
         self.email = email
-        self.allowed_categories = [c.strip().lower() for c in allowed_categories.split(",")]
+        self.allowed_categories_raw = allowed_categories
         self.created_at = created_at
 
+    @property
+    def allowed_categories(self):
+        return parse_allowed_categories(self.allowed_categories_raw)
+
 class SecurityLog:
     def __init__(self, id, user_id, action, ip_address, timestamp, details):
         self.id = id
@@ -42,46 +111,73 @@ class SecurityLog:
         self.timestamp = timestamp
         self.details = details
 
-# Predefined categories with descriptions
+# Predefined categories with descriptions. The ids are what vault.category_id
+# stores, so never renumber them
 CATEGORIES = {
     "medical": {
+        "id": 1,
         "name": "🏥 Medical",
         "description": "Health information, medications, blood type, allergies",
         "icon": "🏥"
     },
     "financial": {
+        "id": 2,
         "name": "💰 Financial", 
         "description": "Bank accounts, credit cards, insurance, investments",
         "icon": "💰"
     },
     "emergency": {
+        "id": 3,
         "name": "🆘 Emergency",
         "description": "Emergency contacts, procedures, important documents",
         "icon": "🆘"
     },
     "personal": {
+        "id": 4,
         "name": "👤 Personal",
         "description": "Personal documents, IDs, passwords, private notes",
         "icon": "👤"
     },
     "work": {
+        "id": 5,
         "name": "💼 Work",
         "description": "Work credentials, projects, professional information",
         "icon": "💼"
     },
     "legal": {
+        "id": 6,
         "name": "⚖️ Legal",
         "description": "Legal documents, contracts, important papers",
         "icon": "⚖️"
     },
     "travel": {
+        "id": 7,
         "name": "✈️ Travel",
         "description": "Travel documents, itineraries, passport info",
         "icon": "✈️"
     },
     "other": {
+        "id": 8,
         "name": "📁 Other",
         "description": "Miscellaneous important information",
         "icon": "📁"
     }
-}
\ No newline at end of file
+}
+
+CATEGORY_KEYS = {category["id"]: key for key, category in CATEGORIES.items()}
+
+def find_category(value):
+    """Resolve a category key, display name or bare name to its CATEGORIES key"""
+    value = value.strip()
+    lowered = value.lower()
+    if lowered in CATEGORIES:
+        return lowered
+    for key, category in CATEGORIES.items():
+        if lowered == category["name"].lower() or lowered == category["name"].split(" ", 1)[-1].lower():
+            return key
+    return None
+
+def find_category_id(value):
+    """Like find_category, but returns the category's id"""
+    key = find_category(value)
+    return CATEGORIES[key]["id"] if key else None
@@ -0,0 +1,137 @@
+"""Parallel decryption for bulk reads
+
+Decryption is CPU-bound and the GIL keeps threads from helping, so large
+batches of ciphertexts are split into chunks and decrypted by a pool of
+worker processes. Every task carries the owning user's data keys; a worker
+builds a DataCipher for a set of keys the first time it sees it and keeps
+it for later tasks.
+
+Small batches aren't worth the round trip to the pool. The engine times
+the serial path as it runs and sends a batch to the pool only when the
+estimated serial time is clearly larger than the pool's measured overhead.
+"""
+import atexit
+import os
+import threading
+import time
+
+from encryption import DataCipher
+
+MIN_PARALLEL_ITEMS = 64     # below this, always decrypt in-process
+CHUNK_BYTES = 256 * 1024    # ciphertext bytes sent to a worker per task
+INITIAL_OVERHEAD = 0.02     # seconds per pool call, until measured
+SMOOTHING = 0.3             # weight of the newest sample in the estimates
+WORKER_KEYRINGS = 32        # key sets a worker keeps a cipher for
+
+_worker_ciphers = {}
+
+def _worker_cipher(keys):
+    cipher = _worker_ciphers.get(keys)
+    if cipher is None:
+        if len(_worker_ciphers) >= WORKER_KEYRINGS:
+            _worker_ciphers.clear()
+        cipher = _worker_ciphers[keys] = DataCipher(keys)
+    return cipher
+
+def _decrypt_chunk(keys, ciphertexts):
+    cipher = _worker_cipher(keys)
+    return [cipher.decrypt_text(data) for data in ciphertexts]
+
+def _chunks(ciphertexts, workers):
+    """Split into runs of at most CHUNK_BYTES, and at least one per worker"""
+    total = sum(len(data) for data in ciphertexts)
+    limit = min(CHUNK_BYTES, max(1, total // workers))
+    chunk, size = [], 0
+    for data in ciphertexts:
+        chunk.append(data)
+        size += len(data)
+        if size >= limit:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+def _ema(old, new):
+    return new if old is None else old + SMOOTHING * (new - old)
+
+class DecryptEngine:
+    """Decrypts lists of ciphertexts, serially or on a process pool"""
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = None
+        self._lock = threading.Lock()
+        self._disabled = self.workers < 2
+        # Measured as we go: serial cost per ciphertext byte, pool overhead per call
+        self.seconds_per_byte = None
+        self.overhead = INITIAL_OVERHEAD
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Imported here: most runs never start the pool, and these
+                # would otherwise add to the startup time of everything importing vault
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # spawn, not fork: the parent has SQLite connections and the
+                # audit writer thread, which must not be copied into workers
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                # Start every worker now so the first batch doesn't pay for it
+                list(self._pool.map(abs, range(self.workers)))
+            return self._pool
+
+    def should_parallelize(self, count, nbytes):
+        if self._disabled or count < MIN_PARALLEL_ITEMS or self.seconds_per_byte is None:
+            return False
+        serial = nbytes * self.seconds_per_byte
+        return serial / self.workers + self.overhead < serial
+
+    def decrypt_serial(self, ciphertexts, keyring):
+        start = time.perf_counter()
+        results = [keyring.decrypt_text(data) for data in ciphertexts]
+        nbytes = sum(len(data) for data in ciphertexts)
+        if nbytes:
+            self.seconds_per_byte = _ema(self.seconds_per_byte, (time.perf_counter() - start) / nbytes)
+        return results
+
+    def decrypt_parallel(self, ciphertexts, keyring):
+        nbytes = sum(len(data) for data in ciphertexts)
+        pool = self._get_pool()
+        start = time.perf_counter()
+        results = []
+        chunks = list(_chunks(ciphertexts, self.workers))
+        for chunk in pool.map(_decrypt_chunk, [keyring.keys] * len(chunks), chunks):
+            results.extend(chunk)
+        elapsed = time.perf_counter() - start
+        expected = nbytes * self.seconds_per_byte / self.workers
+        self.overhead = _ema(self.overhead, max(0.0, elapsed - expected))
+        return results
+
+    def decrypt_many(self, ciphertexts, keyring):
+        """Plaintexts for a list of one user's ciphertexts, in the same order"""
+        ciphertexts = list(ciphertexts)
+        nbytes = sum(len(data) for data in ciphertexts)
+        if self.should_parallelize(len(ciphertexts), nbytes):
+            from concurrent.futures.process import BrokenProcessPool
+
+            try:
+                return self.decrypt_parallel(ciphertexts, keyring)
+            except (BrokenProcessPool, OSError):
+                # No usable pool here (or a worker died): stay serial from now on
+                self.shutdown()
+                self._disabled = True
+        return self.decrypt_serial(ciphertexts, keyring)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+_engine = DecryptEngine()
+atexit.register(_engine.shutdown)
+
+def decrypt_many(ciphertexts, keyring):
+    """Decrypt with a key_store.UserKeyring"""
+    return _engine.decrypt_many(ciphertexts, keyring)
@@ -0,0 +1,86 @@
+"""Size-bounded LRU cache of decrypted entry contents
+
+Repeated reads of the same entry within a session cost a dictionary lookup
+instead of an authenticated decrypt. Plaintext is held for at
+most `ttl` seconds after it was decrypted, the cache never holds more than
+`max_bytes` of it, and clear() drops everything (on logout).
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+MAX_BYTES = 4 * 1024 * 1024
+TTL = 300  # seconds
+
+class PlaintextCache:
+    """Entry id -> plaintext, in least-recently-used order
+
+    Each slot remembers the ciphertext it was decrypted from, so an entry
+    that was edited elsewhere never gets its old plaintext served.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._slots = OrderedDict()  # id -> (ciphertext, plaintext, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def _drop(self, entry_id):
+        slot = self._slots.pop(entry_id, None)
+        if slot is not None:
+            self._bytes -= slot[2]
+
+    def _sweep(self, now):
+        """Drop expired plaintext; runs at most a few times per TTL"""
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.ttl / 4
+        for entry_id in [key for key, slot in self._slots.items() if slot[3] <= now]:
+            self._drop(entry_id)
+
+    def get(self, entry_id, ciphertext):
+        now = time.monotonic()
+        with self._lock:
+            slot = self._slots.get(entry_id)
+            if slot is None or slot[0] != ciphertext or slot[3] <= now:
+                if slot is not None:
+                    self._drop(entry_id)
+                self.misses += 1
+                return None
+            self._slots.move_to_end(entry_id)
+            self.hits += 1
+            return slot[1]
+
+    def put(self, entry_id, ciphertext, plaintext):
+        size = sys.getsizeof(plaintext)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._drop(entry_id)
+            self._slots[entry_id] = (ciphertext, plaintext, size, now + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._slots)))
+            self._sweep(now)
+
+    def discard(self, entry_id):
+        with self._lock:
+            self._drop(entry_id)
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+            self._bytes = 0
@@ -0,0 +1,75 @@
+"""Blind trigram index over encrypted entry content
+
+Each entry's content is lowercased and split into character trigrams. Every
+trigram is stored as a truncated HMAC under a key derived from the user's
+index key (see key_store.py), so the table shows neither the text nor
+which entries of different users share words. The index key is not
+replaced when data keys are rotated, so tokens stay valid across rotations.
+
+A search term's trigrams must all appear for an entry to be a candidate.
+Only candidates are decrypted to confirm the match, which keeps the
+substring semantics search_entries always had.
+"""
+import hmac
+import hashlib
+
+from database import get_connection
+from key_store import get_keyring, decrypt_for_user
+
+NGRAM = 3
+TOKEN_BYTES = 12
+BACKFILL_BATCH = 500
+
+def ngrams(text):
+    text = text.lower()
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+def tokens_for(user_id, text):
+    key = get_keyring(user_id).subkey(b"search-index")
+    return [
+        hmac.new(key, gram.encode(), hashlib.sha256).digest()[:TOKEN_BYTES]
+        for gram in ngrams(text)
+    ]
+
+def index_entry(conn, user_id, entry_id, content):
+    """(Re)index one entry inside the caller's transaction"""
+    conn.execute("DELETE FROM search_tokens WHERE entry_id = ?", (entry_id,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO search_tokens (user_id, token, entry_id) VALUES (?, ?, ?)",
+        [(user_id, token, entry_id) for token in tokens_for(user_id, content)]
+    )
+
+def index_entries(conn, user_id, entries):
+    """Index (entry_id, content) pairs and mark the entries as indexed"""
+    rows = []
+    for entry_id, content in entries:
+        rows.extend((user_id, token, entry_id) for token in tokens_for(user_id, content))
+    conn.executemany("INSERT OR IGNORE INTO search_tokens (user_id, token, entry_id) VALUES (?, ?, ?)", rows)
+    conn.executemany("UPDATE vault SET search_indexed = 1 WHERE id = ?", [(entry_id,) for entry_id, _ in entries])
+
+def ensure_indexed(user_id):
+    """Index any of the user's entries written before the index existed"""
+    conn = get_connection()
+    while True:
+        rows = conn.execute(
+            "SELECT id, encrypted_data FROM vault WHERE user_id = ? AND search_indexed = 0 LIMIT ?",
+            (user_id, BACKFILL_BATCH)
+        ).fetchall()
+        if not rows:
+            return
+        with conn:
+            index_entries(conn, user_id, [(entry_id, decrypt_for_user(user_id, encrypted)) for entry_id, encrypted in rows])
+
+def candidate_ids(user_id, term):
+    """Ids of entries whose content may contain term, or None if term is too short to use the index"""
+    tokens = tokens_for(user_id, term)
+    if not tokens:
+        return None
+    placeholders = ",".join("?" * len(tokens))
+    rows = get_connection().execute(
+        """SELECT entry_id FROM search_tokens
+           WHERE user_id = ? AND token IN ({})
+           GROUP BY entry_id HAVING COUNT(*) = ?""".format(placeholders),
+        (user_id, *tokens, len(tokens))
+    ).fetchall()
+    return {entry_id for (entry_id,) in rows}
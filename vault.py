@@ -1,26 +1,246 @@
-from database import get_cursor, get_connection, log_security_event
-from encryption import encrypt_data, decrypt_data
-from models import VaultData, CATEGORIES
+import weakref
+from database import transaction, fetch_one, fetch_all, get_vault_version, log_security_event, utc_timestamp
+from key_store import with_keyring, encrypt_for_user, decrypt_for_user, forget as forget_keys
+from models import VaultData, EntryContext, CATEGORIES, CATEGORY_KEYS, find_category_id
+from importer import import_entries
+from plaintext_cache import PlaintextCache
+from parallel_decrypt import decrypt_many
+from attachments import entry_blob_ids, remove_unreferenced
+from fuzzy_search import SessionSearchIndex
+from search_index import NGRAM, index_entry, ensure_indexed, candidate_ids
 from ascii_ui import print_error, print_success, print_info, print_data_entry, get_user_choice, print_category_menu, refresh_screen
 
+PAGE_SIZE = 20
+FETCH_SIZE = 500
+
+def fetch_ciphertext(entry_id):
+    """Encrypted content of one entry, or None if it no longer exists"""
+    row = fetch_one("SELECT encrypted_data FROM vault WHERE id = ?", (entry_id,))
+    return row[0] if row else None
+
+LISTING_COLUMNS = "id, user_id, category_id, title, created_at, updated_at"
+
+_contexts = weakref.WeakKeyDictionary()
+_uncached_context = EntryContext(decrypt_for_user, None, fetch_ciphertext)
+
+def entry_context(cache=None):
+    """The EntryContext shared by every entry loaded with cache"""
+    if cache is None:
+        return _uncached_context
+    context = _contexts.get(cache)
+    if context is None:
+        context = _contexts[cache] = EntryContext(decrypt_for_user, cache, fetch_ciphertext)
+    return context
+
+def _listing(rows, cache):
+    # Imported entries share their timestamps, so keep one copy of each. A
+    # dict per listing rather than sys.intern: the interpreter's intern table
+    # would keep an extra entry for every distinct timestamp alive for good
+    context = entry_context(cache)
+    timestamps = {}
+    return [
+        VaultData(id_, user_id, cat, title, None, timestamps.setdefault(created, created),
+                  timestamps.setdefault(updated, updated), context)
+        for id_, user_id, cat, title, created, updated in rows
+    ]
+
+def page_key(entry):
+    """Position of an entry in listing order, for fetch_entry_page's after"""
+    return (entry.category_id, entry.id)
+
+def fetch_entry_page(user_id, after=(0, 0), limit=PAGE_SIZE, cache=None):
+    """Up to limit of a user's entries past the page_key after, grouped by category
+
+    Rows come straight off the (user_id, category_id) index in (category,
+    id) order. Only the listing columns are read; each entry fetches its
+    ciphertext the first time its content is needed.
+    """
+    rows = fetch_all(
+        "SELECT {} FROM vault WHERE user_id = ? AND (category_id, id) > (?, ?) ORDER BY category_id, id LIMIT ?".format(LISTING_COLUMNS),
+        (user_id, *after, limit)
+    )
+    return _listing(rows, cache)
+
+def fetch_entries_in_categories(user_id, category_ids, cache=None):
+    """A user's entries in the given categories, grouped by category"""
+    category_ids = sorted(set(category_ids))
+    if not category_ids:
+        return []
+    rows = fetch_all(
+        "SELECT {} FROM vault WHERE user_id = ? AND category_id IN ({}) ORDER BY category_id, id".format(
+            LISTING_COLUMNS, ",".join("?" * len(category_ids))),
+        (user_id, *category_ids)
+    )
+    return _listing(rows, cache)
+
+def count_entries_by_category(user_id):
+    """category_id -> number of the user's entries, from the trigger-kept counters"""
+    rows = fetch_all(
+        "SELECT category_id, entry_count FROM vault_category_counts WHERE user_id = ? AND entry_count > 0 ORDER BY category_id",
+        (user_id,)
+    )
+    return dict(rows)
+
+def count_entries(user_id):
+    row = fetch_one("SELECT COALESCE(SUM(entry_count), 0) FROM vault_category_counts WHERE user_id = ?", (user_id,))
+    return row[0]
+
+def fetch_recent_entries(user_id, limit=5, cache=None):
+    """The user's most recently updated entries, newest first"""
+    rows = fetch_all(
+        "SELECT {} FROM vault WHERE user_id = ? ORDER BY updated_at DESC, id DESC LIMIT ?".format(LISTING_COLUMNS),
+        (user_id, limit)
+    )
+    return _listing(rows, cache)
+
+def load_ciphertexts(entries):
+    """Fetch the ciphertext of every entry that doesn't have it yet, in bulk"""
+    missing = {entry.id: entry for entry in entries if not entry.ciphertext_loaded}
+    ids = list(missing)
+    for start in range(0, len(ids), FETCH_SIZE):
+        chunk = ids[start:start + FETCH_SIZE]
+        rows = fetch_all(
+            "SELECT id, encrypted_data FROM vault WHERE id IN ({})".format(",".join("?" * len(chunk))), chunk
+        )
+        for entry_id, encrypted in rows:
+            missing[entry_id].encrypted_data = encrypted
+
+def decrypt_entries(entries, cache=None):
+    """Plaintext of each entry, in order
+
+    Cached plaintext is reused; the rest is decrypted as one batch, which
+    goes to the worker processes when it's big enough to be worth it.
+    """
+    load_ciphertexts(entries)
+    contents = [cache.get(entry.id, entry.encrypted_data) if cache else None for entry in entries]
+    # One batch per owner, since each user's data has its own keys
+    pending = {}
+    for i, content in enumerate(contents):
+        if content is None:
+            pending.setdefault(entries[i].user_id, []).append(i)
+    for user_id, indexes in pending.items():
+        ciphertexts = [entries[i].encrypted_data for i in indexes]
+        decrypted = with_keyring(user_id, lambda keyring: decrypt_many(ciphertexts, keyring))
+        for i, content in zip(indexes, decrypted):
+            contents[i] = content
+            if cache is not None:
+                cache.put(entries[i].id, entries[i].encrypted_data, content)
+    return contents
+
+def iter_user_entries(user_id, cache=None, page_size=FETCH_SIZE):
+    """All of a user's entries, read page_size rows at a time"""
+    after = (0, 0)
+    while True:
+        page = fetch_entry_page(user_id, after, page_size, cache)
+        yield from page
+        if len(page) < page_size:
+            return
+        after = page_key(page[-1])
+
+def fetch_user_entries(user_id, cache=None):
+    """All vault entries for a user, content still encrypted and loaded on demand"""
+    return list(iter_user_entries(user_id, cache))
+
 class VaultManager:
     def __init__(self):
-        self.cursor = get_cursor()
-        self.conn = get_connection()
-        self.data_entries = []
         self.current_user_id = None
+        # Entry id -> VaultData, plus the vault version it reflects
+        self._entries = {}
+        self._version = None
+        self.plaintext_cache = PlaintextCache()
+        # Built on the first ranked search, dropped whenever _entries is rebuilt
+        self._search_index = None
+        # Whether the blind index backfill has run for current_user_id; our
+        # own writes index in their transactions, so once is enough
+        self._backfilled = False
 
     def load_user_data(self, user_id):
         """Load data for a specific user"""
+        # Read the version first: if a write lands in between, the cache
+        # looks stale and is reloaded, never the other way round
+        self._version = get_vault_version(user_id)
+        if user_id != self.current_user_id:
+            self.plaintext_cache.clear()
+            self._backfilled = False
         self.current_user_id = user_id
-        self.cursor.execute(
-            "SELECT id, user_id, category, title, encrypted_data, created_at, updated_at FROM vault WHERE user_id = ?",
-            (user_id,)
-        )
-        self.data_entries = [
-            VaultData(id_, user_id, cat, title, enc, created, updated, decrypt_data) 
-            for id_, user_id, cat, title, enc, created, updated in self.cursor.fetchall()
-        ]
+        self._entries = {entry.id: entry for entry in iter_user_entries(user_id, self.plaintext_cache)}
+        self._search_index = None
+
+    def unload(self):
+        """Forget the current user's entries, keys and any decrypted content"""
+        user_id, self.current_user_id = self.current_user_id, None
+        self._entries = {}
+        self._version = None
+        self._search_index = None
+        self._backfilled = False
+        self.plaintext_cache.clear()
+        if user_id is not None:
+            forget_keys(user_id)
+
+    @property
+    def data_entries(self):
+        """The current user's entries, reloaded if someone else changed them"""
+        if self.current_user_id is not None and get_vault_version(self.current_user_id) != self._version:
+            self.load_user_data(self.current_user_id)
+        return list(self._entries.values())
+
+    def _apply_write(self, version, change):
+        """Apply our own committed write to the cache in place
+
+        The write bumped the version by exactly one; anything else means
+        another writer got in too, so the cache is rebuilt instead.
+        """
+        if self._version is not None and version == self._version + 1:
+            change()
+            self._version = version
+        else:
+            self.load_user_data(self.current_user_id)
+
+    def _has_entries(self):
+        return bool(fetch_entry_page(self.current_user_id, limit=1))
+
+    def _browse(self, heading, render, selectable=False):
+        """Page through the user's entries PAGE_SIZE at a time
+
+        render(page, first) prints one page whose entries are numbered from
+        first. With selectable, typing an entry's number returns it; Enter
+        leaves the pager and returns None.
+        """
+        page_starts = [(0, 0)]  # page_key before every page up to the current one
+        while True:
+            rows = fetch_entry_page(self.current_user_id, page_starts[-1], PAGE_SIZE + 1, self.plaintext_cache)
+            page, has_next = rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+            first = (len(page_starts) - 1) * PAGE_SIZE + 1
+            
+            refresh_screen()
+            print(f"\n{heading}")
+            print("═" * 50)
+            render(page, first)
+            print(f"\nShowing {first}-{first + len(page) - 1}")
+            
+            options = []
+            if selectable:
+                options.append("Entry number")
+            if has_next:
+                options.append("[n]ext page")
+            if len(page_starts) > 1:
+                options.append("[p]revious page")
+            options.append("Enter to " + ("cancel" if selectable else "finish"))
+            choice = input(", ".join(options) + ": ").strip().lower()
+            
+            if not choice:
+                return None
+            if choice == "n" and has_next:
+                page_starts.append(page_key(page[-1]))
+            elif choice == "p" and len(page_starts) > 1:
+                page_starts.pop()
+            elif selectable and choice.isdigit() and first <= int(choice) < first + len(page):
+                return page[int(choice) - first]
+
+    @staticmethod
+    def _render_titles(page, first):
+        for i, entry in enumerate(page, first):
+            print(f"{i}. {entry.category} | {entry.title}")
 
     def add_entry(self):
         """Add a new data entry"""
@@ -42,6 +262,7 @@ class VaultManager:
         
         # Get category key
         category_key = list(CATEGORIES.keys())[category_choice - 1]
+        category_id = CATEGORIES[category_key]['id']
         category_name = CATEGORIES[category_key]['name']
         
         # Get entry details
@@ -56,19 +277,36 @@ class VaultManager:
             return False
             
         # Encrypt and save
-        encrypted = encrypt_data(content)
-        self.cursor.execute(
-            "INSERT INTO vault (user_id, category, title, encrypted_data) VALUES (?, ?, ?, ?)", 
-            (self.current_user_id, category_name, title, encrypted)
-        )
-        self.conn.commit()
+        encrypted = encrypt_for_user(self.current_user_id, content)
+        now = utc_timestamp()
+        with transaction() as conn:
+            entry_id = conn.execute(
+                "INSERT INTO vault (user_id, category_id, title, encrypted_data, created_at, updated_at, search_indexed) VALUES (?, ?, ?, ?, ?, ?, 1)", 
+                (self.current_user_id, category_id, title, encrypted, now, now)
+            ).lastrowid
+            index_entry(conn, self.current_user_id, entry_id, content)
+            version = get_vault_version(self.current_user_id, conn)
         
-        # Reload data
-        self.load_user_data(self.current_user_id)
+        # Update the cache
+        new_entry = VaultData(entry_id, self.current_user_id, category_id, title, encrypted, now, now, entry_context(self.plaintext_cache))
+        self._apply_write(version, lambda: self._entries.update({entry_id: new_entry}))
+        if self._search_index is not None:
+            self._search_index.add(entry_id, title, content)
         log_security_event(self.current_user_id, "entry_added", details=f"Category: {category_name}, Title: {title}")
         print_success("Entry added successfully!")
         return True
 
+    def bulk_import(self, path, fmt=None):
+        """Import entries from a JSONL or CSV file without prompting"""
+        if not self.current_user_id:
+            print_error("Not logged in!")
+            return None
+
+        report = import_entries(self.current_user_id, path, fmt)
+        # Reload once for the whole import
+        self.load_user_data(self.current_user_id)
+        return report
+
     def view_all_entries(self):
         """View all user entries"""
         if not self.current_user_id:
@@ -76,28 +314,24 @@ class VaultManager:
             return False
 
         refresh_screen()
-        if not self.data_entries:
+        if not self._has_entries():
             print_info("No data found.")
             return False
-            
-        print("\n📋 All Entries")
-        print("═" * 50)
         
-        # Group by category
-        categories = {}
-        for entry in self.data_entries:
-            if entry.category not in categories:
-                categories[entry.category] = []
-            categories[entry.category].append(entry)
-        
-        for category, entries in categories.items():
-            print(f"\n🏷️  {category.upper()}")
-            print("-" * 30)
-            for entry in entries:
+        def render(page, first):
+            # Decrypt the whole page in one go before printing it
+            decrypt_entries(page, self.plaintext_cache)
+            # Pages come grouped by category; print a heading where it changes
+            category_id = None
+            for entry in page:
+                if entry.category_id != category_id:
+                    category_id = entry.category_id
+                    print(f"\n🏷️  {entry.category.upper()}")
+                    print("-" * 30)
                 print_data_entry(entry)
         
+        self._browse("📋 All Entries", render)
         log_security_event(self.current_user_id, "entries_viewed")
-        input("\nPress Enter to continue...")
         return True
 
     def edit_entry(self):
@@ -106,20 +340,14 @@ class VaultManager:
             print_error("Not logged in!")
             return False
 
-        if not self.data_entries:
+        if not self._has_entries():
             print_info("No data to edit.")
             return False
-            
-        refresh_screen()
-        print("\n✏️  Edit Entry")
-        print("═" * 20)
         
-        # Show available entries
-        for i, entry in enumerate(self.data_entries, 1):
-            print(f"{i}. {entry.category} | {entry.title}")
-        
-        choice = get_user_choice("Select entry to edit: ", (1, len(self.data_entries)))
-        entry = self.data_entries[choice - 1]
+        entry = self._browse("✏️  Edit Entry", self._render_titles, selectable=True)
+        if entry is None:
+            print_info("Operation cancelled.")
+            return False
         
         print(f"\nEditing: {entry.title}")
         print("(Press Enter to keep current value)")
@@ -127,7 +355,12 @@ class VaultManager:
         # Get new values
         new_category = input(f"Category [{entry.category}]: ").strip()
         if not new_category:
-            new_category = entry.category
+            new_category_id = entry.category_id
+        else:
+            new_category_id = find_category_id(new_category)
+            if new_category_id is None:
+                print_error(f"Unknown category! Choose one of: {', '.join(CATEGORIES)}")
+                return False
             
         new_title = input(f"Title [{entry.title}]: ").strip()
         if not new_title:
@@ -138,15 +371,22 @@ class VaultManager:
             new_content = entry.get_decrypted_content()
             
         # Update in database
-        encrypted = encrypt_data(new_content)
-        self.cursor.execute(
-            "UPDATE vault SET category=?, title=?, encrypted_data=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", 
-            (new_category, new_title, encrypted, entry.id)
-        )
-        self.conn.commit()
+        encrypted = encrypt_for_user(entry.user_id, new_content)
+        now = utc_timestamp()
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE vault SET category_id=?, title=?, encrypted_data=?, updated_at=?, search_indexed=1 WHERE id=?", 
+                (new_category_id, new_title, encrypted, now, entry.id)
+            )
+            index_entry(conn, self.current_user_id, entry.id, new_content)
+            version = get_vault_version(self.current_user_id, conn)
         
-        # Reload data
-        self.load_user_data(self.current_user_id)
+        # Update the cache
+        updated = VaultData(entry.id, entry.user_id, new_category_id, new_title, encrypted, entry.created_at, now, entry.context)
+        self.plaintext_cache.put(entry.id, encrypted, new_content)
+        self._apply_write(version, lambda: self._entries.update({entry.id: updated}))
+        if self._search_index is not None:
+            self._search_index.add(entry.id, new_title, new_content)
         log_security_event(self.current_user_id, "entry_edited", details=f"Entry ID: {entry.id}")
         print_success("Entry updated successfully!")
         return True
@@ -157,20 +397,14 @@ class VaultManager:
             print_error("Not logged in!")
             return False
 
-        if not self.data_entries:
+        if not self._has_entries():
             print_info("No data to delete.")
             return False
-            
-        refresh_screen()
-        print("\n🗑️  Delete Entry")
-        print("═" * 20)
-        
-        # Show available entries
-        for i, entry in enumerate(self.data_entries, 1):
-            print(f"{i}. {entry.category} | {entry.title}")
         
-        choice = get_user_choice("Select entry to delete: ", (1, len(self.data_entries)))
-        entry = self.data_entries[choice - 1]
+        entry = self._browse("🗑️  Delete Entry", self._render_titles, selectable=True)
+        if entry is None:
+            print_info("Operation cancelled.")
+            return False
         
         # Confirm deletion
         confirm = input(f"Are you sure you want to delete '{entry.title}'? (yes/no): ").strip().lower()
@@ -178,12 +412,18 @@ class VaultManager:
             print_info("Deletion cancelled.")
             return False
             
-        # Delete from database
-        self.cursor.execute("DELETE FROM vault WHERE id=?", (entry.id,))
-        self.conn.commit()
+        # Delete from database; a trigger drops the attachment rows
+        blob_ids = entry_blob_ids(entry.id)
+        with transaction() as conn:
+            conn.execute("DELETE FROM vault WHERE id=?", (entry.id,))
+            version = get_vault_version(self.current_user_id, conn)
+        remove_unreferenced(blob_ids)
         
-        # Reload data
-        self.load_user_data(self.current_user_id)
+        # Update the cache
+        self.plaintext_cache.discard(entry.id)
+        self._apply_write(version, lambda: self._entries.pop(entry.id, None))
+        if self._search_index is not None:
+            self._search_index.remove(entry.id)
         log_security_event(self.current_user_id, "entry_deleted", details=f"Entry ID: {entry.id}, Title: {entry.title}")
         print_success("Entry deleted successfully!")
         return True
@@ -207,21 +447,17 @@ class VaultManager:
             print_error("Search term cannot be empty!")
             return False
         
-        # Search in titles and content
-        results = []
-        for entry in self.data_entries:
-            if (search_term in entry.title.lower() or 
-                search_term in entry.get_decrypted_content().lower()):
-                results.append(entry)
+        results = self.rank_entries(search_term)
         
         if not results:
             print_info("No entries found matching your search.")
             return False
         
-        print(f"\nFound {len(results)} matching entries:")
+        print(f"\nFound {len(results)} matching entries, best first:")
         print("═" * 40)
         
-        for entry in results:
+        for entry, score in results:
+            print(f"\n🎯 Match: {score:.0%}", end="")
             print_data_entry(entry)
         
         log_security_event(self.current_user_id, "entries_searched", details=f"Search term: {search_term}")
@@ -238,28 +474,65 @@ class VaultManager:
         print("\n📊 Data Statistics")
         print("═" * 20)
         
-        # Count by category
-        categories = {}
-        for entry in self.data_entries:
-            if entry.category not in categories:
-                categories[entry.category] = 0
-            categories[entry.category] += 1
-        
-        print(f"Total entries: {len(self.data_entries)}")
+        stats = self.compute_statistics()
+        print(f"Total entries: {stats['total']}")
         print("\nBy category:")
-        for category, count in categories.items():
+        for category, count in stats['by_category'].items():
             print(f"  • {category}: {count} entries")
         
         # Recent activity
-        if self.data_entries:
-            recent_entries = sorted(self.data_entries, key=lambda x: x.updated_at, reverse=True)[:5]
+        if stats['recent']:
             print(f"\nRecent updates:")
-            for entry in recent_entries:
+            for entry in stats['recent']:
                 print(f"  • {entry.title} ({entry.updated_at})")
         
         input("\nPress Enter to continue...")
         return True
 
+    def get_search_index(self):
+        """The session's ranked search index, built on first use"""
+        entries = self.data_entries  # may reload, which drops the index
+        if self._search_index is None:
+            index = SessionSearchIndex()
+            for entry, content in zip(entries, decrypt_entries(entries, self.plaintext_cache)):
+                index.add(entry.id, entry.title, content)
+            self._search_index = index
+        return self._search_index
+
+    def rank_entries(self, search_term, limit=None):
+        """[(entry, score)] for entries that contain or roughly match search_term, best first"""
+        index = self.get_search_index()
+        return [(self._entries[entry_id], score) for entry_id, score in index.search(search_term, limit)]
+
+    def find_entries(self, search_term):
+        """Entries whose title or content contains the lowercase search term"""
+        entries = self.data_entries
+        candidates = None
+        if len(search_term) >= NGRAM:
+            # Only entries the blind index can't rule out need decrypting
+            if not self._backfilled:
+                ensure_indexed(self.current_user_id)
+                self._backfilled = True
+            candidates = candidate_ids(self.current_user_id, search_term)
+        
+        matches = {entry.id for entry in entries if search_term in entry.title.lower()}
+        to_check = [entry for entry in entries if entry.id not in matches and
+                    (candidates is None or entry.id in candidates)]
+        contents = decrypt_entries(to_check, self.plaintext_cache)
+        matches.update(entry.id for entry, content in zip(to_check, contents) if search_term in content.lower())
+        return [entry for entry in entries if entry.id in matches]
+
+    def compute_statistics(self):
+        """Entry counts by category and the five most recently updated entries"""
+        counts = count_entries_by_category(self.current_user_id)
+        categories = {CATEGORIES[CATEGORY_KEYS.get(category_id, "other")]["name"]: count
+                      for category_id, count in counts.items()}
+        recent_entries = fetch_recent_entries(self.current_user_id, 5, self.plaintext_cache)
+        return {"total": sum(counts.values()), "by_category": categories, "recent": recent_entries}
+
     def get_entries_by_categories(self, allowed_categories):
         """Get entries filtered by allowed categories"""
-        return [entry for entry in self.data_entries if entry.category.lower() in allowed_categories]
\ No newline at end of file
+        category_ids = [find_category_id(category) for category in allowed_categories]
+        return fetch_entries_in_categories(
+            self.current_user_id, [category_id for category_id in category_ids if category_id], self.plaintext_cache
+        )
\ No newline at end of file